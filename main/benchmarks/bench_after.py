@@ -0,0 +1,34 @@
+"""
+Per-call cost of `after` expressions: eval of "lambda x: (...)" on every call (old behaviour)
+against the function precompiled once by src.expression.compile_after.
+
+Run from the main folder: python -m benchmarks.bench_after
+"""
+import timeit
+
+from src.expression import compile_after
+
+
+# (name, after, sample value) - SNILS and applicant name expressions from DataTemplate.create_example_json
+CASES = [
+    ("snils digits", "''.join(c for c in str(x) if c in '1234567890')", "112-233-445 95"),
+    ("snils format", "f'{str(x)[0:3]}-{str(x)[3:6]}-{str(x)[6:9]} {str(x)[9:11]}'", "11223344595"),
+    ("lastName", "x.strip().split(' ')[0]", "Иванов Иван Иванович"),
+    ("middleName", "(x.strip().split(' ')+[None,None,None])[2]", "Иванов Иван Иванович"),
+    ("IP lastName", "(x.strip()[3:] if x.strip().lower().startswith('ип ') else (x.strip()[31:] if x.strip().lower().startswith('индивидуальный предприниматель ') else x.strip())).split(' ')[0]",
+     "ИП Иванов Иван Иванович"),
+]
+NUMBER = 20000
+
+
+def main():
+    print(f"{'expression':<14} {'eval per call, us':>18} {'precompiled, us':>16} {'speedup':>8}")
+    for name, after, value in CASES:
+        old = timeit.timeit(lambda: eval(f"lambda x: ({after})")(value), number=NUMBER) / NUMBER * 1e6
+        func = compile_after(after)
+        new = timeit.timeit(lambda: func(value), number=NUMBER) / NUMBER * 1e6
+        print(f"{name:<14} {old:>18.2f} {new:>16.2f} {old / new:>7.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+FileElement attachment downloads against a local mock file server
+(20 files per object, fixed latency per request), for several attachments_concurrency values.
+attachments_concurrency: 1 is the sequential behaviour.
+
+Run from the main folder: python -m benchmarks.bench_attachments
+"""
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import threading
+import time
+
+import src.config as config
+from src.data_template import FileElement, clear_attachment_cache
+from src.logger import logger
+from src.tunnel_manager import SingleThreadedTunnelManager
+
+
+OBJECTS = 3
+FILES_PER_OBJECT = 20
+FILE_SIZE = 256 * 1024
+LATENCY = 0.02  # seconds per request
+CONCURRENCY = [1, 2, 4, 8, 16]
+
+
+class MockFilesHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(LATENCY)
+        parts = self.path.strip("/").split("/")
+        if parts[:3] == ["api", "files", "raw_version"]:
+            body = bytes(FILE_SIZE)
+        elif parts[:2] == ["api", "files"] and len(parts) == 3:
+            body = json.dumps([
+                {"number": f"{parts[2]}-{k}", "version": 1, "kind": "1", "originalName": f"{k}.pdf"}
+                for k in range(FILES_PER_OBJECT)
+            ]).encode()
+        else:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def main():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockFilesHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    config.loaded_config.api_files_url = f"http://127.0.0.1:{server.server_address[1]}"
+    config.loaded_config.attachments_content = "eager"
+    config.loaded_config.attachments_cache_max_mb = 0  # every run downloads
+    config.loaded_config.attachments_listing_ttl = 0
+    # The mock server is local, no SSH tunnel is needed
+    SingleThreadedTunnelManager.api_connection = lambda self: nullcontext()
+    logger.set_file(os.devnull)  # file listings are logged
+
+    element = FileElement(howto=[])
+    objects = [f"obj{i}" for i in range(OBJECTS)]
+    print(f"{OBJECTS} objects x {FILES_PER_OBJECT} files of {FILE_SIZE // 1024} KiB, {LATENCY * 1000:.0f} ms latency")
+    print(f"{'concurrency':>11} {'seconds':>8} {'speedup':>8}")
+    base = None
+    for concurrency in CONCURRENCY:
+        config.loaded_config.attachments_concurrency = concurrency
+        manager = SingleThreadedTunnelManager.instance()
+        manager.api_http_session = None  # new pool size
+        clear_attachment_cache()
+        start = time.perf_counter()
+        files = element.to_value(None, objects)
+        elapsed = time.perf_counter() - start
+        assert len(files) == OBJECTS * FILES_PER_OBJECT and all(f["_result"] == "OK" for f in files)
+        assert [f["FSuuid"] for f in files] == [f"{obj}-{k}" for obj in objects for k in range(FILES_PER_OBJECT)]
+        base = base or elapsed
+        print(f"{concurrency:>11} {elapsed:>8.2f} {base / elapsed:>7.1f}x")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
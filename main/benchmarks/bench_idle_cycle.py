@@ -0,0 +1,80 @@
+"""
+Record selection of an idle cycle (Steps 2-6 with almost nothing to do) at 100k tracked records:
+full scans of tracker.data, as the steps did before, against the status indexes of RecordTracker
+(get_records_by_status, get_records_with_entries).
+
+Run from the main folder: python -m benchmarks.bench_idle_cycle
+"""
+import json
+import os
+import tempfile
+import time
+
+from src.tracker import RecordTracker
+
+
+RECORDS = 100_000
+ENTRIES_PER_RECORD = 3
+ACTIONABLE = 50  # records with an entry to process in each of Steps 3-6
+REPEAT = 5
+
+# (record status, entry statuses) of Steps 3-6
+STEPS = [
+    ("FORM_SUCC", ("NEW", "VAL_FAIL")),
+    ("FORM_SUCC", ("VAL_SUCCESS", "SEND_ERROR")),
+    ("FORM_SUCC", ("SENT_INFO",)),
+    ("FORM_SUCC", ("DELIVERED", "RESPONSE_PARSE_ERROR")),
+]
+
+
+def make_tracker_json(path: str):
+    actionable = {i * (RECORDS // ACTIONABLE // len(STEPS)): entry_statuses[0]
+                  for i, (_, entry_statuses) in enumerate(STEPS * ACTIONABLE)}
+    data = {
+        f"uid{i}": {
+            "status": "FORM_SUCC",
+            "status_history": [{
+                "parent_number": f"{i}0{k}",
+                "status": actionable.get(i, "RESPONSE_RECEIVED") if k == 0 else "RESPONSE_RECEIVED",
+            } for k in range(ENTRIES_PER_RECORD)],
+        } for i in range(RECORDS)
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+
+
+def scan_cycle(tracker: RecordTracker) -> int:
+    found = len([uid for uid, rec in tracker.data.items() if rec.get("status") in ("NEW", "FORM_FAIL")])
+    for record_status, entry_statuses in STEPS:
+        for uid, rec in tracker.data.items():
+            if rec.get("status") != record_status:
+                continue
+            if tracker.get_status_history_entries_by_status(uid, *entry_statuses):
+                found += 1
+    return found
+
+
+def indexed_cycle(tracker: RecordTracker) -> int:
+    found = len(tracker.get_records_by_status("NEW", "FORM_FAIL"))
+    for record_status, entry_statuses in STEPS:
+        found += len(tracker.get_records_with_entries(record_status, *entry_statuses))
+    return found
+
+
+def main():
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "tracker.json")
+        make_tracker_json(path)
+        start = time.perf_counter()
+        tracker = RecordTracker(path)
+        print(f"{RECORDS} records, loaded and indexed in {time.perf_counter() - start:.2f} s")
+    print(f"{'selection':<10} {'ms/cycle':>9} {'records':>8}")
+    for name, cycle in (("scan", scan_cycle), ("indexes", indexed_cycle)):
+        start = time.perf_counter()
+        for _ in range(REPEAT):
+            found = cycle(tracker)
+        print(f"{name:<10} {(time.perf_counter() - start) / REPEAT * 1000:>9.2f} {found:>8}")
+
+
+if __name__ == "__main__":
+    main()
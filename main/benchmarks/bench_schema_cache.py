@@ -0,0 +1,54 @@
+"""
+XMLGenerator startup with the compiled-schema cache: no cache (build only),
+cold cache (build and write the cache) and warm cache (load the pickle).
+Every start runs in a fresh interpreter, as main.py does.
+
+Run from the main folder: python -m benchmarks.bench_schema_cache
+"""
+import os
+import subprocess
+import sys
+import tempfile
+
+import src.config as config
+
+
+REPEAT = 5
+
+START = """
+import time
+start = time.perf_counter()
+from src.xml_generator import XMLGenerator
+generator = XMLGenerator({xsd!r}, cache_path={cache!r})
+assert generator.schema is not None
+print(time.perf_counter() - start)
+"""
+
+
+def start_time(cache_path: str | None) -> float:
+    code = START.format(xsd=str(config.FILE_SCHEMAS_XSD), cache=cache_path)
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+    return float(output.split()[-1])
+
+
+def main():
+    if not os.path.exists(config.FILE_SCHEMAS_XSD):
+        print(f"No XSD in {config.FILE_SCHEMAS_XSD}")
+        return
+    with tempfile.TemporaryDirectory() as folder:
+        cache_path = os.path.join(folder, "schemas.xsd.pickle")
+        no_cache = cold = warm = 0.0
+        for _ in range(REPEAT):
+            no_cache += start_time(None) / REPEAT
+            if os.path.exists(cache_path):
+                os.remove(cache_path)
+            cold += start_time(cache_path) / REPEAT
+            warm += start_time(cache_path) / REPEAT
+    print(f"{'XMLGenerator start':<20} {'ms':>8}")
+    print(f"{'no cache':<20} {no_cache * 1000:>8.0f}")
+    print(f"{'cold cache':<20} {cold * 1000:>8.0f}")
+    print(f"{'warm cache':<20} {warm * 1000:>8.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Tracker update throughput at 10k, 100k and 1M records (one status_history entry each):
+RecordTracker (rewrites tracker.json on every update), RecordTracker with the journal
+(appends a delta per update, compacts at 16 MB) and SQLiteRecordTracker (one row per update, WAL),
+the last two also with BATCH updates per tracker.batch() (one flush per batch). The SQLite database is filled with the one-shot JSON importer.
+Sizes can be given on the command line: python -m benchmarks.bench_tracker 10000 100000
+
+Run from the main folder: python -m benchmarks.bench_tracker
+"""
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from src.tracker import RecordTracker, SQLiteRecordTracker
+
+
+SIZES = [10_000, 100_000, 1_000_000]
+JSON_SECONDS = 10  # time budget for the JSON updates of one size (every update rewrites the file)
+SQLITE_UPDATES = 5000  # also for the journaled RecordTracker
+JOURNAL_MAX_BYTES = 16 * 1024 * 1024
+BATCH = 30  # updates per tracker.batch() in the batched runs
+
+
+def make_tracker_json(path: str, size: int):
+    data = {
+        f"uid{i}": {
+            "status": "FORM_SUCC",
+            "createRequestId": f"{i}00",
+            "update_seq": 10,
+            "status_history": [{
+                "parent_number": f"{i}00",
+                "status": "DELIVERED",
+                "path_to_xml": f"data/uid{i}.{i}00.xml",
+                "occ_code_raw": "001",
+                "occ_date_raw": "2026-01-01",
+                "created_date": "2026-01-01 12:00:00",
+                "order_number": f"2026{i:06d}",
+                "status_date": "2026-01-01T12:00:00.000000",
+            }],
+        } for i in range(size)
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+
+
+def run_updates(tracker, size: int, max_updates: int, max_seconds: float, batch: int = 1) -> tuple[int, float]:
+    """Alternate the three update methods on random uids, `batch` updates per tracker.batch(), return (updates, seconds)."""
+    rnd = random.Random(0)
+    updates = 0
+    start = time.perf_counter()
+    while updates < max_updates and time.perf_counter() - start < max_seconds:
+        with tracker.batch():
+            for _ in range(batch):
+                i = rnd.randrange(size)
+                kind = updates % 3
+                if kind == 0:
+                    tracker.update_status_history_entry(f"uid{i}", f"{i}00", status="RESPONSE_RECEIVED", response_log_id=updates)
+                elif kind == 1:
+                    tracker.update_record(f"uid{i}", elkOrderNumber=str(updates))
+                else:
+                    tracker.increment_update_seq(f"uid{i}")
+                updates += 1
+    return updates, time.perf_counter() - start
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or SIZES
+    print(f"{'records':>9} {'backend':<8} {'load, s':>8} {'updates':>8} {'updates/s':>10} {'file, MB':>9}")
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as folder:
+            json_path = os.path.join(folder, "tracker.json")
+            db_path = os.path.join(folder, "tracker.sqlite3")
+            make_tracker_json(json_path, size)
+
+            start = time.perf_counter()
+            tracker = SQLiteRecordTracker(db_path)
+            tracker.import_json(json_path)
+            load = time.perf_counter() - start
+            updates, seconds = run_updates(tracker, size, SQLITE_UPDATES, float("inf"))
+            print(f"{size:>9} {'sqlite':<8} {load:>8.2f} {updates:>8} {updates / seconds:>10.0f} "
+                  f"{os.path.getsize(db_path) / 1e6:>9.1f}")
+            updates, seconds = run_updates(tracker, size, SQLITE_UPDATES, float("inf"), BATCH)
+            tracker.close()
+            print(f"{size:>9} {'sqlite':<8} {'batch':>8} {updates:>8} {updates / seconds:>10.0f}")
+
+            start = time.perf_counter()
+            tracker = RecordTracker(json_path, journal_max_bytes=JOURNAL_MAX_BYTES)
+            load = time.perf_counter() - start
+            updates, seconds = run_updates(tracker, size, SQLITE_UPDATES, float("inf"))
+            print(f"{size:>9} {'journal':<8} {load:>8.2f} {updates:>8} {updates / seconds:>10.0f} "
+                  f"{os.path.getsize(tracker.journal_path) / 1e6:>9.1f}")
+            updates, seconds = run_updates(tracker, size, SQLITE_UPDATES, float("inf"), BATCH)
+            tracker.journal.close()
+            print(f"{size:>9} {'journal':<8} {'batch':>8} {updates:>8} {updates / seconds:>10.0f}")
+            os.remove(tracker.journal_path)
+
+            start = time.perf_counter()
+            tracker = RecordTracker(json_path)
+            load = time.perf_counter() - start
+            updates, seconds = run_updates(tracker, size, SQLITE_UPDATES, JSON_SECONDS)
+            print(f"{size:>9} {'json':<8} {load:>8.2f} {updates:>8} {updates / seconds:>10.2f} "
+                  f"{os.path.getsize(json_path) / 1e6:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+XML serialization of filled documents with large attachment lists:
+ElementTree + minidom pretty-printing (old json_to_xml) against the streaming XMLGenerator.write_xml,
+pretty and compact, to a string buffer and to a file. Reports throughput and peak memory (tracemalloc).
+
+Run from the main folder: python -m benchmarks.bench_xml
+"""
+import os
+import tempfile
+import time
+import tracemalloc
+from xml.dom import minidom
+import xml.etree.ElementTree as ET
+
+from src.xml_generator import NAMESPACE, XMLGenerator
+
+
+STATUSES = 20
+FILES_PER_STATUS = 200
+REPEAT = 3
+
+
+def make_document() -> dict:
+    """A CreateOrdersRequest shaped like the filled example template."""
+    def attachment(i: int, k: int) -> dict:
+        return {
+            "FSuuid": f"{i:04d}-{k:04d}-4a22-4633-9a65-c3d8ec882c30",
+            "docTypeId": "150003",
+            "_originalName": f"scan_{k}.pdf",
+            "_name": f"scan_{k}",
+            "_createdDate": "2026-01-01T12:00:00",
+            "_result": "OK",
+        }
+
+    return {
+        "@env": "SVCDEV",
+        "CreateOrdersRequest": {
+            "orders": {
+                "order": [{
+                    "user": {"userPersonalDoc": {"PersonalDocType": "1", "series": "4510", "number": "123456",
+                                                 "lastName": "Иванов", "firstName": "Иван", "middleName": "Иванович",
+                                                 "citizenship": "643", "snils": "112-233-445 95"}},
+                    "senderKpp": "773001001",
+                    "senderInn": "7730176088",
+                    "serviceTargetCode": "-1",
+                    "userSelectedRegion": "00000000",
+                    "orderNumber": "2025000001",
+                    "requestDate": "2026-01-01T12:00:00.000000",
+                    "OfficeInfo": {"OfficeName": "ФИПС & Роспатент <тест>", "ApplicationAcceptance": "-1"},
+                    "statusHistoryList": {
+                        "statusHistory": [{
+                            "status": "6",
+                            "statusDate": f"2026-01-{i % 28 + 1:02d}T12:00:00.000000",
+                            "MessageType": "Регистрация",
+                            "attachments": {"attachment": [attachment(i, k) for k in range(FILES_PER_STATUS)]},
+                        } for i in range(STATUSES)],
+                    },
+                }],
+            },
+        },
+    }
+
+
+def old_json_to_xml(data: dict, root_tag: str = "ElkOrderRequest") -> str:
+    """The former XMLGenerator.json_to_xml: ElementTree, then minidom pretty-printing.
+    Kept as the reference output of write_xml(pretty=True)."""
+    root = ET.Element(f"{{{NAMESPACE}}}{root_tag}")
+    old_dict_to_xml(root, data)
+    return minidom.parseString(ET.tostring(root, encoding='unicode')).toprettyxml(indent="  ", encoding='utf-8').decode('utf-8')
+
+
+def old_dict_to_xml(parent: ET.Element, data: dict):
+    for key, value in data.items():
+        if key.startswith('_'):  # Debug metadata, skip
+            continue
+        if key.startswith('@'):  # Attribute
+            parent.set(key[1:], str(value))
+        elif key == '#text':  # Text content
+            parent.text = str(value)
+        elif isinstance(value, dict):
+            child = ET.SubElement(parent, f"{{{NAMESPACE}}}{key}")
+            old_dict_to_xml(child, value)
+        elif isinstance(value, list):
+            for item in value:
+                child = ET.SubElement(parent, f"{{{NAMESPACE}}}{key}")
+                if isinstance(item, dict):
+                    old_dict_to_xml(child, item)
+                else:
+                    child.text = str(item)
+        else:
+            ET.SubElement(parent, f"{{{NAMESPACE}}}{key}").text = str(value)
+
+
+def measure(name: str, func, size_of):
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        result = func()
+    elapsed = (time.perf_counter() - start) / REPEAT
+    # Peak memory in a separate run, tracemalloc slows allocations down
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    size = size_of(result)
+    print(f"{name:<26} {elapsed * 1000:>9.1f} {size / elapsed / 1e6:>8.1f} {peak / 1e6:>10.1f}")
+    return result
+
+
+def main():
+    generator = XMLGenerator.__new__(XMLGenerator)
+    data = make_document()
+    print(f"{STATUSES} statuses x {FILES_PER_STATUS} attachments")
+    print(f"{'serializer':<26} {'ms/doc':>9} {'MB/s':>8} {'peak, MB':>10}")
+    old = measure("ElementTree + minidom", lambda: old_json_to_xml(data), len)
+    new = measure("write_xml pretty, str", lambda: generator.json_to_xml(data), len)
+    if new != old:
+        raise Exception("write_xml(pretty=True) differs from the ElementTree + minidom output")
+    measure("write_xml compact, str", lambda: generator.json_to_xml(data, pretty=False), len)
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "out.xml")
+
+        def to_file(pretty: bool):
+            with open(path, "w", encoding="utf-8") as f:
+                generator.write_xml(data, f, pretty=pretty)
+            return path
+
+        measure("write_xml pretty, file", lambda: to_file(True), os.path.getsize)
+        measure("write_xml compact, file", lambda: to_file(False), os.path.getsize)
+
+
+if __name__ == "__main__":
+    main()
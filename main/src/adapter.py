@@ -13,7 +13,9 @@ from src.tunnel_manager import SingleThreadedTunnelManager
 def send_xml_path(xml_path: str) -> requests.models.Response:
     with open(xml_path, "r", encoding="utf-8") as f:
         xml_content = f.read()
-    xml_content = re.sub(r'>\s+<', '><', xml_content).replace("\n", "")
+    if "\n" in xml_content:
+        # Indented XML (written before compact output), strip it
+        xml_content = re.sub(r'>\s+<', '><', xml_content).replace("\n", "")
     return send_xml_content(xml_content)
 
 
@@ -6,12 +6,15 @@ import yaml
 DATA_FOLDER = Path("./data")
 DATA_FOLDER.mkdir(parents=True, exist_ok=True)
 FILE_SCHEMAS_XSD = DATA_FOLDER / "schemas.xsd"
+FILE_SCHEMAS_CACHE = DATA_FOLDER / "schemas.xsd.pickle"
 FILE_TEMPLATE_JSON = DATA_FOLDER / "template.json"
 FILE_TEMPLATE_UPDATE_JSON = DATA_FOLDER / "template_update.json"
 FILE_DB_DEBUG = DATA_FOLDER / "_db_debug.txt"
 MONITOR_STARTING_DATE_COL = "appl_receiving_date"
 TRACKER_JSON = DATA_FOLDER / "tracker.json"
+TRACKER_DB = DATA_FOLDER / "tracker.sqlite3"
 STATUS_TEMPLATE_JSON = DATA_FOLDER / "status_template.json"
+ATTACHMENTS_CACHE_FOLDER = DATA_FOLDER / "attachments_cache"
 
 
 class LoadedConfig:
@@ -42,8 +45,22 @@ class LoadedConfig:
         self.db_adapter_password = config["db_adapter_password"]
 
         self.api_files_url = config.get("api_files_url", "http://10.2.53.15:4300")
+        self.attachments_content = config.get("attachments_content", "lazy")  # lazy/eager
+        self.attachments_concurrency = config.get("attachments_concurrency", 4)
+        self.attachments_cache_max_mb = config.get("attachments_cache_max_mb", 1024)  # 0 - no disk cache
+        self.attachments_listing_ttl = config.get("attachments_listing_ttl", 600)  # seconds, 0 - no listing cache
+        self.attachments_listing_max_entries = config.get("attachments_listing_max_entries", 10000)
 
         self.sleep_interval = config.get("sleep_interval", 10)
+        self.tracker_backend = config.get("tracker_backend", "json")  # json/sqlite
+        self.tracker_journal_max_mb = config.get("tracker_journal_max_mb", 16)  # 0 - rewrite tracker.json on every update
+        self.scan_full_diff_hours = config.get("scan_full_diff_hours", 24)  # full diff of known uids in Step 1, else keyset scan
+        self.tracker_batch_max_seconds = config.get("tracker_batch_max_seconds", 10)  # longest delay of a tracker flush in a batch
+        self.tracker_batch_records = config.get("tracker_batch_records", 100)  # records of a step whose tracker updates are flushed together
+        self.validation_workers = config.get("validation_workers", 0)  # 0 - validate in the main process, N - in N worker processes
+        self.fill_batch_size = config.get("fill_batch_size", 100)
+        self.compile_howto_chains = config.get("compile_howto_chains", False)
+        self.fill_engine = config.get("fill_engine", "steps")  # steps/document
         self.monitor_starting_date = config.get("monitor_starting_date", "2025-12-31")
         self.status_mapping = config.get("status_mapping", {})
         self.debug = config.get("debug", {})
@@ -1,8 +1,13 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import copy
 from datetime import datetime, timedelta
+import re
 import traceback
-from typing import Any, Self
+from typing import Any, Callable, Self
 
 from src.db_connector import DBConnector
+from src.expression import compile_after
+from src.file_cache import CHUNK_SIZE, AttachmentContent, get_attachment_disk_cache, get_listing_cache
 from src.logger import logger
 from src.validate import validate_list_functions
 import src.config as config
@@ -26,15 +31,154 @@ def set_value_dict_list(x, path: list, new_val: Any):
     x[path[-1]] = new_val
 
 
-class DataTemplateHowToElement:
+class LookupCache:
+    """Memo of DataTemplateHowToElement lookups, scoped to a single fill.
+
+    The same howto chains (rutmk_uid -> contact_uid -> fips_contact.*) are repeated
+    by many elements of a template, so most lookups of one fill are identical.
+    Raw rows are cached (before `after` is applied), keyed by
+    (table, column, condition_column, clause_after_when, value, multiple).
+    """
+    def __init__(self):
+        self.rows: dict[tuple, list] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple) -> list | None:
+        rows = self.rows.get(key)
+        if rows is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return rows
+
+    def contains(self, key: tuple) -> bool:
+        return key in self.rows
+
+    def put(self, key: tuple, rows: list):
+        self.rows[key] = rows
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.rows = {}
+        self.reset_stats()
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self.rows)}
+
+
+_lookup_cache = LookupCache()
+
+def clear_lookup_cache():
+    _lookup_cache.clear()
+
+def get_lookup_cache_stats() -> dict[str, int]:
+    return _lookup_cache.stats()
+
+def lookup_cache() -> LookupCache:
+    """The lookup cache of the current fill (for prefetchers filling it ahead of _fill_recursive)."""
+    return _lookup_cache
+
+
+class AttachmentCache:
+    """Contents of attachments downloaded during a single fill.
+
+    Every status entry walks to the same objects, so without it one file
+    is downloaded once per status. Keyed by (object number, file number, version),
+    values are futures of (content, result), so downloads still in progress are shared too.
+    """
+    def __init__(self):
+        self.contents: dict[tuple, Future] = {}
+        self.downloads = 0
+        self.avoided = 0
+
+    def get_or_download(self, key: tuple, download: Callable[[], Future]) -> Future:
+        content = self.contents.get(key)
+        if content is None:
+            content = self.contents[key] = download()
+            self.downloads += 1
+        else:
+            self.avoided += 1
+        return content
+
+    def clear(self):
+        self.contents = {}
+        self.downloads = 0
+        self.avoided = 0
+
+    def stats(self) -> dict[str, int]:
+        return {"downloads": self.downloads, "avoided": self.avoided}
+
+
+_attachment_cache = AttachmentCache()
+
+def clear_attachment_cache():
+    # A new cache, so lazy file entries of the previous fill keep the one they were created with
+    global _attachment_cache
+    _attachment_cache = AttachmentCache()
+
+def get_attachment_cache_stats() -> dict[str, int]:
+    return _attachment_cache.stats()
+
+def _completed_future(result: Any) -> Future:
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+class LazyFileEntry(dict):
+    """File entry of FileElement (attachments_content: lazy) without the file content.
+
+    `_content_base64` and `_result` are downloaded on first access by key or .get(),
+    so content that no template field consumes (the XML generator skips `_` keys)
+    is never transferred. Iteration and `in` see only the fields present so far.
+    """
+    LAZY_KEYS = ("_content_base64", "_result")
+
+    def __init__(self, entry: dict, download: Callable[[], tuple[AttachmentContent | None, str]]):
+        super().__init__(entry)
+        self._download = download
+
+    def __missing__(self, key):
+        if key not in self.LAZY_KEYS:
+            raise KeyError(key)
+        self["_content_base64"], self["_result"] = self._download()
+        return self[key]
+
+    def get(self, key, default=None):
+        if key in self.LAZY_KEYS:
+            return self[key]
+        return super().get(key, default)
+
+
+class TemplateNode:
+    """Base class of parsed template nodes. Attributes are fixed by __slots__ and can not be
+    reassigned once __init__ is done, so one parsed template is safely shared by all fills."""
+    __slots__ = ("_frozen",)
+
+    def __setattr__(self, name: str, value: Any):
+        if getattr(self, "_frozen", False):
+            raise AttributeError(f"{type(self).__name__} is immutable, can not set {name}")
+        object.__setattr__(self, name, value)
+
+
+class DataTemplateHowToElement(TemplateNode):
+    __slots__ = ("table_name", "column_name", "condition_column", "after", "after_func",
+                 "clause_after_when", "multiple")
+
     def __init__(self, table_name: str, column_name: str, condition_column: str = None,
                  after: str = None, clause_after_when: str = None, multiple: bool = False):
         self.table_name = table_name
         self.column_name = column_name
         self.condition_column = condition_column
         self.after = after
+        self.after_func = compile_after(after) if after is not None else None
         self.clause_after_when = clause_after_when
         self.multiple = multiple
+        self._frozen = True
 
     @staticmethod
     def from_dict(obj: dict) -> Self:
@@ -60,17 +204,78 @@ class DataTemplateHowToElement:
         result = {k: result[k] for k in result if result[k] is not None}
         return result
 
-    def to_value(self, db_connector: DBConnector, condition_value: Any):
-        cond_val = condition_value[0] if isinstance(condition_value, tuple) else condition_value
-        condition_column = (self.condition_column if self.condition_column is not None
-                            else db_connector.get_index_column_name())
+    def _cache_key(self, condition_column: str, cond_val: Any) -> tuple:
+        return (self.table_name, self.column_name, condition_column,
+                self.clause_after_when, str(cond_val), self.multiple)
+
+    def get_condition_column(self, db_connector: DBConnector) -> str:
+        return (self.condition_column if self.condition_column is not None
+                else db_connector.get_index_column_name())
+
+    def has_plain_clause(self) -> bool:
+        """Whether this lookup can be combined with others into one query
+        (clauses that limit or reorder the result are only valid on their own)."""
+        if self.clause_after_when is None:
+            return True
+        return re.search(r"\b(limit|offset|order|group|union)\b", self.clause_after_when, re.IGNORECASE) is None
+
+    def row_order(self) -> str:
+        """ORDER BY for the rows of one condition value: the physical row order (ctid), so the first value
+        and `multiple` lists are the same whether the rows come from the per-value or the batched query.
+        Clauses that are not plain (see has_plain_clause) keep their own order."""
+        return f'ORDER BY "{self.table_name}".ctid' if self.has_plain_clause() else ''
+
+    def prefetch(self, db_connector: DBConnector, condition_values: list):
+        """Fetch rows for all condition_values with a single query and put them into the lookup cache,
+        so that subsequent to_value calls for these values are cache hits."""
+        if not self.has_plain_clause():
+            return
+        condition_column = self.get_condition_column(db_connector)
+        missing = set()
+        for value in condition_values:
+            value = value[0] if isinstance(value, tuple) else value
+            if value is None or isinstance(value, (list, dict)):
+                continue
+            if not _lookup_cache.contains(self._cache_key(condition_column, value)):
+                missing.add(str(value))
+        if not missing:
+            return
+        column_type = db_connector.get_column_type(self.table_name, condition_column)
+        if column_type is not None:
+            condition = f'"{self.table_name}"."{condition_column}" = _batch._value::{column_type}'
+        else:
+            condition = f'"{self.table_name}"."{condition_column}"::text = _batch._value'
         req = f"""
-            SELECT "{self.column_name}" FROM "{self.table_name}"
-            WHERE "{condition_column}" = '{cond_val}' {self.clause_after_when if self.clause_after_when is not None else ''}
+            SELECT _batch._value, "{self.table_name}"."{self.column_name}"
+            FROM unnest(%s::text[]) AS _batch(_value), "{self.table_name}"
+            WHERE {condition} {self.clause_after_when if self.clause_after_when is not None else ''}
+            ORDER BY _batch._value, "{self.table_name}".ctid
         """
-        data = db_connector.fetchall(req)
-        logger.log("Debug", "to_value\n", data, "\n", req)
+        data = db_connector.fetchall(req, (sorted(missing),))
+        rows_by_value = {value: [] for value in missing}
+        for value, column_value in data:
+            rows_by_value[value].append((column_value,))
+        for value, rows in rows_by_value.items():
+            _lookup_cache.put(self._cache_key(condition_column, value), rows)
 
+    def to_value(self, db_connector: DBConnector, condition_value: Any):
+        cond_val = condition_value[0] if isinstance(condition_value, tuple) else condition_value
+        condition_column = self.get_condition_column(db_connector)
+        cache_key = self._cache_key(condition_column, cond_val)
+        data = _lookup_cache.get(cache_key)
+        if data is None:
+            req = f"""
+                SELECT "{self.column_name}" FROM "{self.table_name}"
+                WHERE "{condition_column}" = '{cond_val}' {self.clause_after_when if self.clause_after_when is not None else ''}
+                {self.row_order()}
+            """
+            data = db_connector.fetchall(req)
+            _lookup_cache.put(cache_key, data)
+            logger.log("Debug", "to_value\n", data, "\n", req)
+        return self.rows_to_value(data)
+
+    def rows_to_value(self, data: list):
+        """Convert fetched rows to the value of this lookup (first value or list of values, then `after`)."""
         if self.multiple:
             # Return a list of first column values, applying `after` to each if present
             if not data:
@@ -79,7 +284,7 @@ class DataTemplateHowToElement:
                 values = [(row[0] if row is not None else None) for row in data]
             if self.after is not None:
                 try:
-                    foo = eval(f"lambda x: ({self.after})")
+                    foo = self.after_func
                     values = [foo(v) for v in values]
                 except Exception:
                     raise Exception(f"Elements in {values} could not be formatted using after={self.after}")
@@ -92,19 +297,124 @@ class DataTemplateHowToElement:
                 val = data[0][0]
             if self.after is not None:
                 try:
-                    foo = eval(f"lambda x: ({self.after})")
+                    foo = self.after_func
                     val = foo(val)
                 except Exception:
                     raise Exception(f"{val} could not be formatted using after={self.after}")
             return val
 
 
-class FileElement:
+def split_howto_chain(howto: list[DataTemplateHowToElement]) -> list[list[DataTemplateHowToElement]]:
+    """Split a howto chain into segments which can be compiled into one query each:
+    a segment ends with a step that has `after` (run in Python on the intermediate value)
+    or returns multiple values."""
+    segments = []
+    current = []
+    for howto_el in howto:
+        current.append(howto_el)
+        if howto_el.after is not None or howto_el.multiple:
+            segments.append(current)
+            current = []
+    if current:
+        segments.append(current)
+    return segments
+
+
+def compile_howto_segment(segment: list[DataTemplateHowToElement], db_connector: DBConnector,
+                          value_sql: str = "%s", select_order: bool = False) -> str | None:
+    """
+    Compile a howto segment into one SQL statement. The first condition value is value_sql: either
+    the %s parameter or a text SQL expression (e.g. a column of an outer query).
+    Each step becomes a scalar subquery feeding the condition of the next one, cast the same way as
+    the value would be when substituted into the next query text. Every step is ordered by row_order(),
+    as it is when evaluated step by step; with select_order the ctid of the result rows is selected as
+    a second column, for queries that have to restore that order themselves. Returns None if the segment
+    can not be compiled (in which case it is evaluated step by step).
+    """
+    if not all(howto_el.has_plain_clause() for howto_el in segment):
+        return None
+    req = None
+    previous = value_sql
+    for howto_el in segment:
+        condition_column = howto_el.get_condition_column(db_connector)
+        if previous == "%s":
+            condition = f'"{condition_column}" = %s'
+        else:
+            column_type = db_connector.get_column_type(howto_el.table_name, condition_column)
+            if column_type is not None:
+                condition = f'"{condition_column}" = CAST({previous} AS {column_type})'
+            else:
+                condition = f'"{condition_column}"::text = {previous}'
+        clause = howto_el.clause_after_when if howto_el.clause_after_when is not None else ''
+        columns = f'"{howto_el.column_name}"'
+        if select_order and howto_el is segment[-1]:
+            columns += f', "{howto_el.table_name}".ctid'
+        req = f'SELECT {columns} FROM "{howto_el.table_name}" WHERE {condition} {clause} {howto_el.row_order()}'
+        previous = f"({req} LIMIT 1)::text"
+    return req
+
+
+def segment_cache_key(segment: list[DataTemplateHowToElement], db_connector: DBConnector, cond_val: Any) -> tuple:
+    """Lookup cache key of a segment result (the plain lookup key for single-step segments)."""
+    if len(segment) == 1:
+        return segment[0]._cache_key(segment[0].get_condition_column(db_connector), cond_val)
+    return ("chain", str(cond_val)) + tuple(
+        (howto_el.table_name, howto_el.column_name, howto_el.get_condition_column(db_connector),
+         howto_el.clause_after_when, howto_el.multiple)
+        for howto_el in segment
+    )
+
+
+def segment_to_value(segment: list[DataTemplateHowToElement], db_connector: DBConnector, condition_value: Any):
+    """Value of one segment of a howto chain (see split_howto_chain), from the lookup cache when it is there."""
+    first = segment[0]
+    cond_val = condition_value[0] if isinstance(condition_value, tuple) else condition_value
+    if len(segment) == 1 or cond_val is None or isinstance(cond_val, (list, dict)):
+        return _steps_to_value(segment, db_connector, condition_value)
+    cache_key = segment_cache_key(segment, db_connector, cond_val)
+    if not _lookup_cache.contains(cache_key) and (
+            not config.loaded_config.compile_howto_chains
+            or _lookup_cache.contains(first._cache_key(first.get_condition_column(db_connector), cond_val))):
+        # Not compiled or already prefetched step by step
+        return _steps_to_value(segment, db_connector, condition_value)
+    data = _lookup_cache.get(cache_key)
+    if data is None:
+        req = compile_howto_segment(segment, db_connector)
+        if req is None:
+            return _steps_to_value(segment, db_connector, condition_value)
+        data = db_connector.fetchall(req, (str(cond_val),))
+        _lookup_cache.put(cache_key, data)
+        logger.log("Debug", "compiled to_value\n", data, "\n", req)
+    return segment[-1].rows_to_value(data)
+
+
+def _steps_to_value(howto: list[DataTemplateHowToElement], db_connector: DBConnector, ind: Any):
+    last = ind
+    for howto_el in howto:
+        last = howto_el.to_value(db_connector, last)
+    return last
+
+
+def evaluate_howto_chain(howto: list[DataTemplateHowToElement], db_connector: DBConnector, ind: Any):
+    """Evaluate a howto chain starting from ind. If compile_howto_chains is enabled in the config,
+    every segment of the chain (see split_howto_chain) costs one DB round-trip instead of one per step.
+    Segments prefetched by the document engine are taken from the lookup cache either way."""
+    last = ind
+    for segment in split_howto_chain(howto):
+        last = segment_to_value(segment, db_connector, last)
+    return last
+
+
+class FileElement(TemplateNode):
     """Элемент, который скачивает файлы из внешнего API по списку идентификаторов."""
+    __slots__ = ("howto", "after", "after_func", "tuple_index")
+
     def __init__(self, howto: list[DataTemplateHowToElement], after: str = None, tuple_index: int = None):
         self.howto = howto
         self.after = after
+        self.after_func = compile_after(after) if after is not None else None
         self.tuple_index = tuple_index
+        self._frozen = True
 
     @staticmethod
     def from_dict(obj: dict):
@@ -130,11 +440,7 @@ class FileElement:
             ind = ind[self.tuple_index]
 
         # 1. Вычисляем список идентификаторов объектов (статусных)
-        last = ind
-        for howto_el in self.howto:
-            val = howto_el.to_value(db_connector, last)
-            last = val
-        status_object_numbers = last
+        status_object_numbers = evaluate_howto_chain(self.howto, db_connector, ind)
         if not isinstance(status_object_numbers, list):
             # Если вернулся не список, превращаем в список (один элемент)
             status_object_numbers = [status_object_numbers] if status_object_numbers is not None else []
@@ -143,75 +449,154 @@ class FileElement:
         all_files = []
         from src.config import loaded_config
         from src.tunnel_manager import SingleThreadedTunnelManager
-        import requests
-        import base64
 
         api_base = loaded_config.api_files_url
-
-        for obj_number in status_object_numbers:
-            files_list = []
-            try:
-                # Получить список файлов для объекта
-                with SingleThreadedTunnelManager.instance().api_connection():
-                    resp = requests.get(f"{api_base}/api/files/{obj_number}", timeout=30)
-                    if resp.status_code != 200:
-                        raise Exception(f"HTTP {resp.status_code}: {resp.text[:200]}")
-                    file_metadata = resp.json()  # ожидается список
-                    logger.log(str(file_metadata))
-
+        lazy = loaded_config.attachments_content == "lazy"
+        tunnel_manager = SingleThreadedTunnelManager.instance()
+        with tunnel_manager.api_connection(), \
+                ThreadPoolExecutor(max_workers=max(1, loaded_config.attachments_concurrency)) as executor:
+            session = tunnel_manager.api_session()
+            # Списки файлов всех объектов запрашиваются параллельно, порядок объектов сохраняется
+            listings = list(executor.map(lambda obj_number: self._list_files(session, api_base, obj_number),
+                                         status_object_numbers))
+            for obj_number, (file_metadata, error) in zip(status_object_numbers, listings):
+                if error is not None:
+                    # Если не удалось получить даже список – добавим фиктивный элемент с ошибкой
+                    all_files.append({
+                        "FSuuid": None,
+                        "docTypeId": None,
+                        "_originalName": None,
+                        "_name": None,
+                        "_createdDate": None,
+                        "_content_base64": None,
+                        "_result": f"ERROR: {str(error)}",
+                        "_object_number": obj_number,  # для отладки
+                    })
+                    continue
+                logger.log(str(file_metadata))
                 for file_info in file_metadata:
                     file_number = file_info.get('number')
                     version = file_info.get('version', 1)
-                    # Скачать содержимое файла
-                    content_b64 = None
-                    result_status = "OK"
-                    try:
-                        with SingleThreadedTunnelManager.instance().api_connection():
-                            content_resp = requests.get(
-                                f"{api_base}/api/files/raw_version/{obj_number}/{file_number}/{version}",
-                                timeout=30
-                            )
-                            if content_resp.status_code == 200:
-                                content_b64 = base64.b64encode(content_resp.content).decode('ascii')
-                            else:
-                                result_status = f"ERROR: HTTP {content_resp.status_code}"
-                    except Exception as e:
-                        result_status = f"ERROR: {str(e)}"
-
                     file_entry = {
                         "FSuuid": file_number,
                         "docTypeId": file_info.get('kind'),
                         "_originalName": file_info.get('originalName'),
                         "_name": file_info.get('name'),
                         "_createdDate": file_info.get('createdDate'),
-                        "_content_base64": content_b64,
-                        "_result": result_status,
                     }
-                    files_list.append(file_entry)
-            except Exception as e:
-                # Если не удалось получить даже список – добавим фиктивный элемент с ошибкой
-                files_list.append({
-                    "FSuuid": file_number,
-                    "docTypeId": file_info.get('kind'),
-                    "_originalName": None,
-                    "_name": None,
-                    "_createdDate": None,
-                    "_content_base64": None,
-                    "_result": f"ERROR: {str(e)}",
-                    "_object_number": obj_number,  # для отладки
-                })
-            all_files.extend(files_list)
+                    if lazy:
+                        # Содержимое скачивается только при обращении к нему,
+                        # через кэш и сессию этого заполнения, а не те, что текущие в момент обращения
+                        file_entry = LazyFileEntry(file_entry, lambda obj_number=obj_number, file_number=file_number, version=version,
+                                                   cache=_attachment_cache, session=session:
+                                                   self._cached_content(cache, session, api_base, obj_number, file_number, version))
+                    else:
+                        # Скачать содержимое файла (один раз за заполнение, параллельно)
+                        file_entry["_content_base64"] = _attachment_cache.get_or_download(
+                            (str(obj_number), str(file_number), str(version)),
+                            lambda: executor.submit(self._download_content, session, api_base, obj_number, file_number, version)
+                        )
+                    all_files.append(file_entry)
+            if not lazy:
+                for file_entry in all_files:
+                    if isinstance(file_entry["_content_base64"], Future):
+                        file_entry["_content_base64"], file_entry["_result"] = file_entry["_content_base64"].result()
 
         # 3. Применить after, если задан
         if self.after is not None:
             try:
-                foo = eval(f"lambda x: ({self.after})")
+                foo = self.after_func
                 all_files = foo(all_files)
             except Exception as e:
                 raise Exception(f"FileElement after transformation failed: {e}")
 
         return all_files
 
+    @staticmethod
+    def _list_files(session, api_base: str, obj_number) -> tuple[list | None, Exception | None]:
+        """Get the file listing of an object (possibly from the listing cache),
+        returns (listing, error); runs in worker threads."""
+        listing_cache = get_listing_cache()
+        if listing_cache is not None:
+            listing = listing_cache.get(obj_number)
+            if listing is not None:
+                return listing, None
+        try:
+            resp = session.get(f"{api_base}/api/files/{obj_number}", timeout=30)
+            if resp.status_code != 200:
+                raise Exception(f"HTTP {resp.status_code}: {resp.text[:200]}")
+            listing = resp.json()  # ожидается список
+        except Exception as e:
+            return None, e
+        if listing_cache is not None:
+            listing_cache.put(obj_number, listing)
+        return listing, None
+
+    @staticmethod
+    def _cached_content(cache: AttachmentCache, session, api_base: str, obj_number, file_number, version) -> tuple[AttachmentContent | None, str]:
+        """Content of one file version, downloaded once per fill
+        (cache and session are the ones of the fill that created the entry)."""
+        from src.tunnel_manager import SingleThreadedTunnelManager
+
+        def download() -> Future:
+            # Bodies on disk do not need the API tunnel at all
+            content = FileElement._content_from_disk(obj_number, file_number, version)
+            if content is not None:
+                return _completed_future(content)
+            tunnel_manager = SingleThreadedTunnelManager.instance()
+            with tunnel_manager.api_connection():
+                return _completed_future(FileElement._download_content(
+                    session, api_base, obj_number, file_number, version))
+
+        content_key = (str(obj_number), str(file_number), str(version))
+        return cache.get_or_download(content_key, download).result()
+
+    @staticmethod
+    def _content_from_disk(obj_number, file_number, version) -> tuple[AttachmentContent, str] | None:
+        """(content, result) from the on-disk attachment cache, None if it is not there."""
+        disk_cache = get_attachment_disk_cache()
+        if disk_cache is None:
+            return None
+        content = disk_cache.get((str(obj_number), str(file_number), str(version)))
+        if content is None:
+            return None
+        return content, "OK"
+
+    @staticmethod
+    def _download_content(session, api_base: str, obj_number, file_number, version) -> tuple[AttachmentContent | None, str]:
+        """Download one file version (unless it is in the on-disk cache),
+        returns (content, result); runs in worker threads.
+        The body is streamed in chunks to a spooled temporary file (see AttachmentContent),
+        it is base64-encoded only when the document is serialized."""
+        content = FileElement._content_from_disk(obj_number, file_number, version)
+        if content is not None:
+            return content
+        content = None
+        result_status = "OK"
+        try:
+            with session.get(
+                f"{api_base}/api/files/raw_version/{obj_number}/{file_number}/{version}",
+                timeout=30,
+                stream=True
+            ) as content_resp:
+                if content_resp.status_code == 200:
+                    content = AttachmentContent(content_resp.iter_content(CHUNK_SIZE))
+                else:
+                    result_status = f"ERROR: HTTP {content_resp.status_code}"
+            if content is not None:
+                disk_cache = get_attachment_disk_cache()
+                if disk_cache is not None:
+                    try:
+                        disk_cache.put((str(obj_number), str(file_number), str(version)), content)
+                    except OSError as e:
+                        logger.log(f"WARNING: could not store attachment {obj_number}/{file_number}/{version} on disk: {e}")
+        except Exception as e:
+            content = None
+            result_status = f"ERROR: {str(e)}"
+        return content, result_status
+
+
+PREFETCH_FAILED = object()  # result of a prefetched chain that failed, the per-uid fill reports the error
 
 _validation_errors = []
 
@@ -227,13 +612,17 @@ def get_validation_errors():
     return _validation_errors
 
 
-class DataTemplateElement:
+class DataTemplateElement(TemplateNode):
+    __slots__ = ("example", "howto", "after", "after_func", "validate", "tuple_index")
+
     def __init__(self, example: str, howto: list[DataTemplateHowToElement], after: str = None, validate: list[str] = None, tuple_index: int = 0):
         self.example = example
         self.howto = howto
         self.after = after
+        self.after_func = compile_after(after) if after is not None else None
         self.validate = validate if validate is not None else []
         self.tuple_index = tuple_index
+        self._frozen = True
 
     @staticmethod
     def from_dict_able(obj: dict) -> bool:
@@ -269,14 +658,10 @@ class DataTemplateElement:
             raise Exception("DataTemplateElement::to_value got ind=None")
         if isinstance(ind, tuple):
             ind = ind[self.tuple_index]
-        last_result = ind
-        for howto_el in self.howto:
-            data = howto_el.to_value(db_connector, last_result)
-            last_result = data
-        data = last_result
+        data = evaluate_howto_chain(self.howto, db_connector, ind)
         if self.after is not None:
             try:
-                foo = eval(f"lambda x: ({self.after})")
+                foo = self.after_func
                 data = foo(data)
             except Exception:
                 raise Exception(f"{data} could not be formatted using after={self.after}")
@@ -287,7 +672,11 @@ class DataTemplateElement:
         return str(data)
 
 
-class ConditionalElement:
+class ConditionalElement(TemplateNode):
+    # Only one of the condition_* slots is set (checked with hasattr)
+    __slots__ = ("howto", "result", "condition_value_equal", "condition_values_in",
+                 "condition_values_not_in", "condition_value_empty")
+
     def __init__(self, howto: list[DataTemplateHowToElement], result, **conditions):
         self.howto = howto
         self.result = result
@@ -302,6 +691,7 @@ class ConditionalElement:
             self.condition_value_empty = conditions['condition_value_empty']
         else:
             raise ValueError("ConditionalElement must have one condition")
+        self._frozen = True
 
     @staticmethod
     def from_dict(obj: dict):
@@ -350,13 +740,15 @@ class ConditionalElement:
     def to_value(self, db_connector: DBConnector, ind: Any):
         """Evaluate the howto chain, check condition, and return the result (or None)."""
         # Walk the howto chain starting from ind
-        last = ind
-        for howto_el in self.howto:
-            val = howto_el.to_value(db_connector, last)
-            last = val
-        condition_value = last
+        condition_value = evaluate_howto_chain(self.howto, db_connector, ind)
+
+        if self.is_condition_met(condition_value):
+            # Return the result as‑is – it will be further processed by the recursive fill
+            return self.result
+        else:
+            return None   # signal that this branch should be omitted
 
-        # Determine if condition is met
+    def is_condition_met(self, condition_value: Any) -> bool:
         condition_met = False
         if hasattr(self, 'condition_value_equal'):
             condition_met = (condition_value == self.condition_value_equal)
@@ -369,19 +761,18 @@ class ConditionalElement:
             # condition_value_empty = False -> we want the value to be non‑empty
             is_empty = (condition_value is None or condition_value == '')
             condition_met = (is_empty == self.condition_value_empty)
+        return condition_met
 
-        if condition_met:
-            # Return the result as‑is – it will be further processed by the recursive fill
-            return self.result
-        else:
-            return None   # signal that this branch should be omitted
 
+class ListElement(TemplateNode):
+    __slots__ = ("howto", "template", "after", "after_func")
 
-class ListElement:
     def __init__(self, howto: list[DataTemplateHowToElement], template, after: str = None):
         self.howto = howto
         self.template = template
         self.after = after
+        self.after_func = compile_after(after) if after is not None else None
+        self._frozen = True
 
     @staticmethod
     def from_dict(obj: dict):
@@ -402,10 +793,7 @@ class ListElement:
 
     def to_value(self, db_connector: DBConnector, ind: Any):
         # Evaluate howto chain to get a list
-        last = ind
-        for howto_el in self.howto:
-            val = howto_el.to_value(db_connector, last)
-            last = val
+        last = evaluate_howto_chain(self.howto, db_connector, ind)
         # last must be a list
         if not isinstance(last, list):
             raise Exception(f"ListElement expected a list from howto, got {type(last)}")
@@ -414,7 +802,8 @@ class ListElement:
 
 class DataTemplate:
     def __init__(self, data_template_json: dict):
-        # Recursively convert all special markers to objects
+        # Recursively convert all special markers to objects.
+        # The parsed tree is never modified by fills, so one DataTemplate serves all records.
         self.data = self._convert_special_nodes(data_template_json)
 
     @staticmethod
@@ -458,23 +847,34 @@ class DataTemplate:
             # Base type (str, int, etc.) – return unchanged
             return node
 
-    def _fill_recursive(self, node, db_connector, ind):
+    def _fill_recursive(self, node, db_connector, ind, path: tuple = (), replace: dict[tuple, Any] = None,
+                        list_filter: dict[tuple, set[str]] = None):
         """
         Recursively walk the structure and evaluate any special nodes.
         Returns the processed node (which may be a dict, list, string, or None).
+        path is the position of node in the template (dict keys and list indices),
+        subtrees whose path is in replace are not evaluated, a copy of the stand-in is returned instead.
+        ListElements whose path is in list_filter are expanded only for the listed (outer) values.
         """
-        if isinstance(node, dict):
+        if replace and path in replace:
+            return copy.deepcopy(replace[path])
+
+        if isinstance(node, LazyFileEntry):
+            # Downloaded file entry, contains no template nodes
+            return node
+
+        elif isinstance(node, dict):
             new_dict = {}
             for key, value in node.items():
-                processed = self._fill_recursive(value, db_connector, ind)
+                processed = self._fill_recursive(value, db_connector, ind, path + (key,), replace, list_filter)
                 if processed is not None:   # omit keys that evaluate to None
                     new_dict[key] = processed
             return new_dict
 
         elif isinstance(node, list):
             new_list = []
-            for item in node:
-                processed = self._fill_recursive(item, db_connector, ind)
+            for i, item in enumerate(node):
+                processed = self._fill_recursive(item, db_connector, ind, path + (i,), replace, list_filter)
                 if processed is not None:   # optionally remove None from lists
                     new_list.append(processed)
             return new_list
@@ -489,19 +889,20 @@ class DataTemplate:
             if result is None:
                 return None
             # The result may contain more special nodes – process them
-            return self._fill_recursive(result, db_connector, ind)
+            return self._fill_recursive(result, db_connector, ind, path, replace, list_filter)
 
         elif isinstance(node, ListElement):
             outer_vals = node.to_value(db_connector, ind)   # list from node.howto
+            if list_filter and path in list_filter:
+                outer_vals = [val for val in outer_vals if str(val) in list_filter[path]]
             results = []
             # If the template is another ListElement → nested flattening
             if isinstance(node.template, ListElement):
                 for outer_val in outer_vals:
-                    inner_list_elem = ListElement.from_dict(node.template.to_dict())
-                    inner_vals = inner_list_elem.to_value(db_connector, outer_val)
+                    inner_vals = node.template.to_value(db_connector, outer_val)
                     for inner_val in inner_vals:
-                        # Pass tuple (outer, inner) to the innermost template (inner_list_elem.template)
-                        filled = self._fill_recursive(inner_list_elem.template, db_connector, (ind, outer_val, inner_val))
+                        # Pass tuple (outer, inner) to the innermost template (node.template.template)
+                        filled = self._fill_recursive(node.template.template, db_connector, (ind, outer_val, inner_val))
                         if filled is not None:
                             results.append(filled)
             else:
@@ -512,7 +913,7 @@ class DataTemplate:
                         results.append(filled)
             # Apply optional after (if any) to each result
             if node.after is not None:
-                foo = eval(f"lambda x: ({node.after})")
+                foo = node.after_func
                 results = [foo(r) for r in results]
             return results
 
@@ -525,9 +926,148 @@ class DataTemplate:
             # Plain value (str, int, etc.)
             return node
 
-    def fill_template(self, db_connector: DBConnector, ind: Any) -> Any:
-        self.data = self._fill_recursive(self.data, db_connector, ind)
-        for val, path in iterate_recursively_dict_list(self.data):
+    def _prefetch_howto(self, howto: list[DataTemplateHowToElement], db_connector: DBConnector, inds: list) -> list:
+        """Evaluate a howto chain for all inds, one query per step for the whole batch.
+        Returns the chain results aligned with inds (PREFETCH_FAILED where evaluation failed;
+        such inds are left for the regular per-uid fill to report)."""
+        values = list(inds)
+        for howto_el in howto:
+            howto_el.prefetch(db_connector, [v for v in values if v is not PREFETCH_FAILED])
+            new_values = []
+            for value in values:
+                if value is not PREFETCH_FAILED:
+                    try:
+                        value = howto_el.to_value(db_connector, value)
+                    except Exception:
+                        value = PREFETCH_FAILED
+                new_values.append(value)
+            values = new_values
+        return values
+
+    def _prefetch_recursive(self, node, db_connector: DBConnector, inds: list,
+                            path: tuple = (), replace: dict[tuple, Any] = None,
+                            list_filter: dict[tuple, set[str]] = None):
+        """
+        Walk the structure the same way _fill_recursive does, but for a batch of inds at once,
+        filling the lookup cache so the per-uid fill afterwards needs (almost) no queries.
+        """
+        if not inds or (replace and path in replace):
+            return
+
+        if isinstance(node, dict):
+            for key, value in node.items():
+                self._prefetch_recursive(value, db_connector, inds, path + (key,), replace, list_filter)
+
+        elif isinstance(node, list):
+            for i, item in enumerate(node):
+                self._prefetch_recursive(item, db_connector, inds, path + (i,), replace, list_filter)
+
+        elif isinstance(node, DataTemplateElement):
+            self._prefetch_howto(node.howto, db_connector,
+                                 [ind[node.tuple_index] if isinstance(ind, tuple) else ind for ind in inds])
+
+        elif isinstance(node, ConditionalElement):
+            condition_values = self._prefetch_howto(node.howto, db_connector, inds)
+            inds_met = [ind for ind, value in zip(inds, condition_values)
+                        if value is not PREFETCH_FAILED and node.is_condition_met(value)]
+            self._prefetch_recursive(node.result, db_connector, inds_met, path, replace, list_filter)
+
+        elif isinstance(node, ListElement):
+            outer_lists = self._prefetch_howto(node.howto, db_connector, inds)
+            pairs = [(ind, outer_val) for ind, outer_vals in zip(inds, outer_lists)
+                     if isinstance(outer_vals, list) for outer_val in outer_vals]
+            if list_filter and path in list_filter:
+                pairs = [(ind, outer_val) for ind, outer_val in pairs if str(outer_val) in list_filter[path]]
+            if isinstance(node.template, ListElement):
+                inner_lists = self._prefetch_howto(node.template.howto, db_connector,
+                                                   [outer_val for _, outer_val in pairs])
+                triples = [(ind, outer_val, inner_val) for (ind, outer_val), inner_vals in zip(pairs, inner_lists)
+                           if isinstance(inner_vals, list) for inner_val in inner_vals]
+                self._prefetch_recursive(node.template.template, db_connector, triples)
+            else:
+                self._prefetch_recursive(node.template, db_connector, pairs)
+
+        elif isinstance(node, FileElement):
+            self._prefetch_howto(node.howto, db_connector,
+                                 [ind[node.tuple_index] if node.tuple_index is not None else ind for ind in inds])
+
+    def fill_many(self, db_connector: DBConnector, uids: list, batch_size: int = None, log_path=None,
+                  engine: str = None, replace: dict[tuple, Any] = None, list_filter: dict[tuple, set[str]] = None):
+        """
+        Fill the template for many uids, yielding (uid, data, error) in the order of uids.
+        With engine="steps" each howto step is evaluated once per batch (joined against unnest(%s::text[])
+        of the batch values, see DataTemplateHowToElement.prefetch),
+        with engine="document" all lookups of a template level are evaluated in one statement
+        (see src.document_engine). Then every uid is filled from the lookup cache.
+        replace and list_filter are the same as for fill_template.
+        Validation errors are cleared before each uid, so
+        get_validation_errors() refers to the uid just yielded.
+        If log_path is given, logger is switched to log_path(uid) before filling each uid.
+        """
+        if batch_size is None:
+            batch_size = config.loaded_config.fill_batch_size
+        if engine is None:
+            engine = config.loaded_config.fill_engine
+        for start in range(0, len(uids), batch_size):
+            batch = uids[start:start + batch_size]
+            clear_lookup_cache()
+            try:
+                if engine == "document":
+                    from src.document_engine import DocumentPrefetcher
+                    DocumentPrefetcher(db_connector).prefetch(self.data, batch, replace, list_filter)
+                else:
+                    self._prefetch_recursive(self.data, db_connector, batch, replace=replace, list_filter=list_filter)
+                logger.log(f"Prefetched {get_lookup_cache_stats()['entries']} lookups for a batch of {len(batch)} uids")
+            except Exception:
+                logger.log(f"WARNING: batch prefetch failed, falling back to per-uid queries:\n{traceback.format_exc()}", force_print=True)
+            for uid in batch:
+                if log_path is not None:
+                    logger.set_file(log_path(uid), clear=True)
+                clear_validation_errors()
+                _lookup_cache.reset_stats()
+                clear_attachment_cache()
+                try:
+                    data = self._fill_recursive(self.data, db_connector, uid, replace=replace, list_filter=list_filter)
+                    self._apply_debug_replace(data)
+                except Exception as e:
+                    yield uid, None, e
+                    continue
+                stats = get_lookup_cache_stats()
+                logger.log(f"Lookup cache for {uid}: {stats['hits']} hits, {stats['misses']} misses (DB round-trips)")
+                self._log_attachment_stats(uid)
+                yield uid, data, None
+
+    def fill_template(self, db_connector: DBConnector, ind: Any, replace: dict[tuple, Any] = None,
+                      list_filter: dict[tuple, set[str]] = None) -> Any:
+        """
+        Fill the template for ind and return the filled document (self.data is left unchanged).
+        replace maps template paths, e.g. ("CreateOrdersRequest", "orders", "order", 0, "statusHistoryList"),
+        to static stand-ins used instead of evaluating that subtree (None omits the key).
+        list_filter maps paths of ListElements to the outer values (as str) to materialize,
+        other items of the list, with their nested lists and files, are not evaluated.
+        """
+        clear_lookup_cache()
+        clear_attachment_cache()
+        data = self._fill_recursive(self.data, db_connector, ind, replace=replace, list_filter=list_filter)
+        stats = get_lookup_cache_stats()
+        logger.log(f"Lookup cache for {ind}: {stats['hits']} hits, {stats['misses']} misses (DB round-trips)")
+        self._log_attachment_stats(ind)
+        self._apply_debug_replace(data)
+        return data
+
+    @staticmethod
+    def _log_attachment_stats(ind: Any):
+        stats = get_attachment_cache_stats()
+        if stats["downloads"] or stats["avoided"]:
+            logger.log(f"Attachments for {ind}: {stats['downloads']} downloaded, {stats['avoided']} duplicate downloads avoided")
+        listing_cache = get_listing_cache()
+        if listing_cache is not None and (listing_cache.hits or listing_cache.misses):
+            stats = listing_cache.stats()
+            logger.log(f"File listing cache: {stats['hits']} hits, {stats['misses']} misses, {stats['entries']} entries")
+
+    @staticmethod
+    def _apply_debug_replace(data: Any):
+        for val, path in iterate_recursively_dict_list(data):
             if not isinstance(val, (list, dict)):
                 if "date" in config.loaded_config.debug.get("replace", {}):
                     replace_kind = config.loaded_config.debug["replace"]["date"]
@@ -538,13 +1078,12 @@ class DataTemplate:
                     theday = theday.strftime('%Y-%m-%d')
                     if path[-1] in ("statusDate", "requestDate"):
                         logger.log("\n", "WARNING", "debug date substitution has been activated", force_print=True)
-                        set_value_dict_list(self.data, path, f"{theday}T00:00:00.000000")
+                        set_value_dict_list(data, path, f"{theday}T00:00:00.000000")
                 if "orderNumber" in config.loaded_config.debug.get("replace", {}):
                     replace_dict = config.loaded_config.debug["replace"]["orderNumber"]
                     if path[-1] == "orderNumber" and str(val) in replace_dict:
                         logger.log("\n", "WARNING", "debug orderNumber substitution has been activated", force_print=True)
-                        set_value_dict_list(self.data, path, replace_dict[str(val)])
-        return ind
+                        set_value_dict_list(data, path, replace_dict[str(val)])
 
     @staticmethod
     def create_example_json() -> dict[str, Any]:
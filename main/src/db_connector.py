@@ -1,3 +1,5 @@
+import io
+
 import psycopg2
 from sshtunnel import SSHTunnelForwarder
 
@@ -6,9 +8,27 @@ from src.tunnel_manager import SingleThreadedTunnelManager
 
 
 class DBConnector:
+    def __init__(self):
+        self._column_types: dict[tuple[str, str], str | None] = {}
+
     def get_index_column_name(self) -> str:
         return "rutmk_uid"
 
+    def get_column_type(self, table_name: str, column_name: str) -> str | None:
+        """SQL type of a column (e.g. 'uuid', 'character varying'), cached per connector.
+        Returns None if the column can not be found."""
+        key = (table_name, column_name)
+        if key not in self._column_types:
+            rows = self.fetchall(
+                """
+                    SELECT format_type(a.atttypid, NULL) FROM pg_attribute a
+                    WHERE a.attrelid = to_regclass(%s) AND a.attname = %s AND NOT a.attisdropped
+                """,
+                (f'"{table_name}"', column_name)
+            )
+            self._column_types[key] = rows[0][0] if rows else None
+        return self._column_types[key]
+
     def fetchall(self, request: str, params: tuple = None) -> list:
         try:
             with SingleThreadedTunnelManager.instance().db_appl_connection() as conn:
@@ -23,6 +43,26 @@ class DBConnector:
             print("fetchall error:", request, params)
             raise
 
+    def fetchall_with_values(self, request: str, params: tuple, table_name: str, column_type: str, values) -> list:
+        """Like fetchall, but first loads values into a temporary one-column table `table_name (value column_type)`
+        with COPY, in the same transaction, so the request can join against it instead of a huge IN list.
+        The table is dropped at the end of the transaction."""
+        data = "".join(
+            str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r") + "\n"
+            for value in values
+        )
+        try:
+            with SingleThreadedTunnelManager.instance().db_appl_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(f"CREATE TEMP TABLE {table_name} (value {column_type}) ON COMMIT DROP")
+                    cur.copy_expert(f"COPY {table_name} (value) FROM STDIN", io.StringIO(data))
+                    cur.execute(f"ANALYZE {table_name}")
+                    cur.execute(request, params)
+                    return cur.fetchall()
+        except Exception:
+            print("fetchall_with_values error:", request, params, table_name)
+            raise
+
     def get_debug_info(self) -> str:
         result = ""
         result += "All tables:\n"
@@ -0,0 +1,162 @@
+from typing import Any
+
+from src.data_template import (
+    ConditionalElement, DataTemplateElement, FileElement, ListElement, DataTemplateHowToElement,
+    PREFETCH_FAILED, compile_howto_segment, lookup_cache, segment_cache_key, segment_to_value,
+    split_howto_chain,
+)
+from src.db_connector import DBConnector
+from src.logger import logger
+
+
+class DocumentPrefetcher:
+    """
+    Whole-document rendering engine for DataTemplate.fill_many (fill_engine: document).
+
+    The template is evaluated level by level for a batch of uids: all howto chains of one level
+    (element values, ConditionalElement conditions, ListElement fan-outs) are compiled into
+    LATERAL subqueries and sent together as one UNION ALL statement per result column type.
+    Conditional results and list templates form the next level. The lookup cache is filled with
+    the results, so _fill_recursive afterwards assembles documents without issuing queries, and
+    the number of round-trips depends on the template depth instead of its size.
+    Chain segments separated by `after` need one extra statement each, since `after` runs in Python.
+    """
+    def __init__(self, db_connector: DBConnector):
+        self.db_connector = db_connector
+        self.statements = 0
+
+    def prefetch(self, template_data: Any, uids: list, replace: dict[tuple, Any] = None,
+                 list_filter: dict[tuple, set[str]] = None):
+        """Fill the lookup cache for all uids; subtrees whose path is in replace are skipped,
+        ListElements whose path is in list_filter are expanded only for the listed values."""
+        # (node, inds, path) - path is None inside list templates, where replace does not apply
+        pending_nodes = [(template_data, list(uids), ())]
+        pending_chains = []
+        while pending_nodes or pending_chains:
+            chains = pending_chains
+            pending_chains = []
+            for node, inds, path in pending_nodes:
+                self._collect_chains(node, inds, chains, path, replace, list_filter)
+            pending_nodes = []
+
+            results = self._evaluate_chains([(howto, inds) for howto, inds, _ in chains])
+            for (howto, inds, continuation), values in zip(chains, results):
+                if continuation is None:
+                    continue
+                kind, node, extra = continuation
+                if kind == "condition":
+                    inds_met = [ind for ind, value in zip(inds, values)
+                                if value is not PREFETCH_FAILED and node.is_condition_met(value)]
+                    if inds_met:
+                        pending_nodes.append((node.result, inds_met, extra))
+                elif kind == "list":
+                    pairs = [(ind, outer_val) for ind, outer_vals in zip(inds, values)
+                             if isinstance(outer_vals, list) for outer_val in outer_vals
+                             if extra is None or str(outer_val) in extra]
+                    if not pairs:
+                        continue
+                    if isinstance(node.template, ListElement):
+                        pending_chains.append((node.template.howto, [outer_val for _, outer_val in pairs],
+                                               ("inner_list", node.template, pairs)))
+                    else:
+                        pending_nodes.append((node.template, pairs, None))
+                elif kind == "inner_list":
+                    triples = [(ind, outer_val, inner_val) for (ind, outer_val), inner_vals in zip(extra, values)
+                               if isinstance(inner_vals, list) for inner_val in inner_vals]
+                    if triples:
+                        pending_nodes.append((node.template, triples, None))
+        logger.log(f"Document engine: {self.statements} statements for a batch of {len(uids)} uids")
+
+    def _collect_chains(self, node, inds: list, chains: list, path: tuple | None,
+                        replace: dict[tuple, Any] | None, list_filter: dict[tuple, set[str]] | None):
+        """Collect (howto, inds, continuation) for every chain of this level of the template."""
+        if not inds or (path is not None and replace and path in replace):
+            return
+        if isinstance(node, dict):
+            for key, value in node.items():
+                self._collect_chains(value, inds, chains, None if path is None else path + (key,), replace, list_filter)
+        elif isinstance(node, list):
+            for i, item in enumerate(node):
+                self._collect_chains(item, inds, chains, None if path is None else path + (i,), replace, list_filter)
+        elif isinstance(node, DataTemplateElement):
+            chains.append((node.howto, [ind[node.tuple_index] if isinstance(ind, tuple) else ind for ind in inds], None))
+        elif isinstance(node, ConditionalElement):
+            chains.append((node.howto, inds, ("condition", node, path)))
+        elif isinstance(node, ListElement):
+            allowed = list_filter.get(path) if list_filter and path is not None else None
+            chains.append((node.howto, inds, ("list", node, allowed)))
+        elif isinstance(node, FileElement):
+            chains.append((node.howto, [ind[node.tuple_index] if node.tuple_index is not None else ind for ind in inds], None))
+
+    def _evaluate_chains(self, chains: list[tuple[list[DataTemplateHowToElement], list]]) -> list[list]:
+        """Evaluate all chains segment by segment; segment i of every chain is fetched in the same round."""
+        all_values = [list(inds) for _, inds in chains]
+        all_segments = [split_howto_chain(howto) for howto, _ in chains]
+        rounds = max((len(segments) for segments in all_segments), default=0)
+        for round_i in range(rounds):
+            tasks = [(segments[round_i], values) for segments, values in zip(all_segments, all_values)
+                     if round_i < len(segments)]
+            self._fetch_segments(tasks)
+            for segments, values in zip(all_segments, all_values):
+                if round_i >= len(segments):
+                    continue
+                for i, value in enumerate(values):
+                    if value is PREFETCH_FAILED:
+                        continue
+                    try:
+                        values[i] = segment_to_value(segments[round_i], self.db_connector, value)
+                    except Exception:
+                        values[i] = PREFETCH_FAILED
+        return all_values
+
+    def _fetch_segments(self, tasks: list[tuple[list[DataTemplateHowToElement], list]]):
+        """Fetch rows of all (segment, condition values) tasks, one statement per result column type."""
+        groups: dict[Any, list] = {}
+        for segment, values in tasks:
+            if not all(howto_el.has_plain_clause() for howto_el in segment):
+                continue
+            missing = set()
+            for value in values:
+                value = value[0] if isinstance(value, tuple) else value
+                if value is PREFETCH_FAILED or value is None or isinstance(value, (list, dict)):
+                    continue
+                if not lookup_cache().contains(segment_cache_key(segment, self.db_connector, value)):
+                    missing.add(str(value))
+            if not missing:
+                continue
+            last = segment[-1]
+            result_type = self.db_connector.get_column_type(last.table_name, last.column_name)
+            # Columns of unknown type can not be safely united with others
+            group_key = result_type if result_type is not None else id(segment)
+            groups.setdefault(group_key, []).append((segment, sorted(missing)))
+
+        for group in groups.values():
+            parts = []
+            params = []
+            for task_i, (segment, missing) in enumerate(group):
+                req = compile_howto_segment(segment, self.db_connector, value_sql="_batch._value", select_order=True)
+                if not segment[-1].multiple:
+                    req += " LIMIT 1"
+                parts.append(f"""
+                    SELECT {task_i} AS _task, _batch._value, _rows._result, _rows._order
+                    FROM unnest(%s::text[]) AS _batch(_value)
+                    CROSS JOIN LATERAL ({req}) AS _rows(_result, _order)
+                """)
+                params.append(missing)
+            try:
+                # Neither the join nor UNION ALL keeps the order of the rows of a value, so it is restored here:
+                # the same row_order() as the per-uid queries use, which the lookup cache entries are shared with
+                data = self.db_connector.fetchall("UNION ALL".join(parts) + " ORDER BY _task, _value, _order",
+                                                  tuple(params))
+            except Exception as e:
+                # Leave these lookups to the per-uid fill
+                logger.log(f"WARNING: document engine statement failed, falling back to per-uid queries: {e}", force_print=True)
+                continue
+            finally:
+                self.statements += 1
+            rows = {(task_i, value): [] for task_i, (_, missing) in enumerate(group) for value in missing}
+            for task_i, value, result, _ in data:
+                rows[(task_i, value)].append((result,))
+            for (task_i, value), task_rows in rows.items():
+                segment = group[task_i][0]
+                lookup_cache().put(segment_cache_key(segment, self.db_connector, value), task_rows)
@@ -0,0 +1,72 @@
+import ast
+from datetime import datetime, timedelta
+from typing import Any, Callable
+
+import src.config as config
+
+
+# Builtins available to `after` expressions
+SAFE_BUILTINS = {
+    "abs": abs, "all": all, "any": any, "bool": bool, "dict": dict, "enumerate": enumerate,
+    "filter": filter, "float": float, "int": int, "isinstance": isinstance, "len": len,
+    "list": list, "map": map, "max": max, "min": min, "range": range, "reversed": reversed,
+    "round": round, "set": set, "sorted": sorted, "str": str, "sum": sum, "tuple": tuple, "zip": zip,
+}
+
+# Other names `after` expressions may use (besides x and comprehension variables)
+SAFE_GLOBALS = {
+    "config": config,
+    "datetime": datetime,
+    "timedelta": timedelta,
+}
+
+ALLOWED_NODES = (
+    ast.Expression, ast.Lambda, ast.arguments, ast.arg,
+    ast.BoolOp, ast.BinOp, ast.UnaryOp, ast.IfExp, ast.Compare, ast.Call, ast.keyword,
+    ast.Dict, ast.Set, ast.Tuple, ast.List, ast.Starred,
+    ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp, ast.comprehension,
+    ast.JoinedStr, ast.FormattedValue, ast.Constant,
+    ast.Attribute, ast.Subscript, ast.Slice, ast.Name, ast.Load, ast.Store,
+    ast.boolop, ast.operator, ast.unaryop, ast.cmpop,
+)
+
+_compiled_after: dict[str, Callable[[Any], Any]] = {}
+
+
+def check_after(expression: str) -> ast.Expression:
+    """Parse an `after` expression as `lambda x: (expression)` and check it against the whitelist.
+    Raises ValueError describing the first forbidden construct."""
+    try:
+        tree = ast.parse(f"lambda x: ({expression})", mode="eval")
+    except SyntaxError as e:
+        raise ValueError(f"Invalid after expression {expression!r}: {e.msg}")
+
+    bound_names = {"x"}
+    for node in ast.walk(tree):
+        if isinstance(node, ast.comprehension):
+            for target in ast.walk(node.target):
+                if isinstance(target, ast.Name):
+                    bound_names.add(target.id)
+    for node in ast.walk(tree):
+        if not isinstance(node, ALLOWED_NODES):
+            raise ValueError(f"Invalid after expression {expression!r}: {type(node).__name__} is not allowed")
+        if isinstance(node, ast.Attribute) and node.attr.startswith("_"):
+            raise ValueError(f"Invalid after expression {expression!r}: attribute {node.attr} is not allowed")
+        if isinstance(node, ast.Name) and node.id not in bound_names \
+                and node.id not in SAFE_BUILTINS and node.id not in SAFE_GLOBALS:
+            raise ValueError(f"Invalid after expression {expression!r}: name {node.id} is not allowed")
+    # The wrapping lambda must be the only one
+    if sum(isinstance(node, ast.Lambda) for node in ast.walk(tree)) != 1:
+        raise ValueError(f"Invalid after expression {expression!r}: Lambda is not allowed")
+    return tree
+
+
+def compile_after(expression: str) -> Callable[[Any], Any]:
+    """Return the function `lambda x: (expression)`, checked and compiled once per expression string."""
+    func = _compiled_after.get(expression)
+    if func is None:
+        tree = check_after(expression)
+        code = compile(tree, f"<after: {expression}>", "eval")
+        func = eval(code, {"__builtins__": SAFE_BUILTINS, **SAFE_GLOBALS})
+        _compiled_after[expression] = func
+    return func
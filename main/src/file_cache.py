@@ -0,0 +1,252 @@
+import base64
+from collections import OrderedDict
+import hashlib
+import os
+from pathlib import Path
+import tempfile
+import threading
+import time
+from typing import Any, Iterable, Iterator
+
+import src.config as config
+
+
+SPOOL_MAX_SIZE = 1024 * 1024  # bodies up to this size stay in memory
+CHUNK_SIZE = 48 * 1024  # multiple of 3, so base64 of chunks can be concatenated
+
+
+class AttachmentContent:
+    """Body of an attachment, spooled to a temporary file in chunks.
+
+    Stands in the filled document for the base64 string (`_content_base64`):
+    the body is encoded only when serialized with str() or iter_base64(),
+    and deep copies of the document share the handle instead of copying the body.
+    """
+    def __init__(self, chunks: Iterable[bytes] = ()):
+        self.file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        self.lock = threading.Lock()
+        self.size = 0
+        for chunk in chunks:
+            self.file.write(chunk)
+            self.size += len(chunk)
+
+    def chunks(self, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+        offset = 0
+        while True:
+            with self.lock:
+                self.file.seek(offset)
+                chunk = self.file.read(chunk_size)
+            if not chunk:
+                return
+            offset += len(chunk)
+            yield chunk
+
+    def iter_base64(self) -> Iterator[str]:
+        for chunk in self.chunks():
+            yield base64.b64encode(chunk).decode("ascii")
+
+    def __str__(self) -> str:
+        return "".join(self.iter_base64())
+
+    def __repr__(self) -> str:
+        return f"<AttachmentContent {self.size} bytes>"
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __bool__(self) -> bool:
+        return True
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    @property
+    def closed(self) -> bool:
+        return self.file.closed
+
+    def close(self):
+        """Release the spooled body (memory or temporary file); the content can not be read afterwards."""
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        file = getattr(self, "file", None)
+        if file is not None:
+            file.close()
+
+
+def close_attachment_contents(data: Any):
+    """Close every AttachmentContent in a filled document (nested dicts and lists), once it has been written.
+    Lazy file entries that were never accessed have no content to close and are not downloaded."""
+    if isinstance(data, AttachmentContent):
+        data.close()
+    elif isinstance(data, dict):
+        for value in data.values():
+            close_attachment_contents(value)
+    elif isinstance(data, list):
+        for value in data:
+            close_attachment_contents(value)
+
+
+class AttachmentDiskCache:
+    """On-disk cache of attachment bodies, shared by all fills and cycles.
+
+    A file version never changes, so a body is stored once under the hash of
+    (object number, file number, version) and hits are never revalidated.
+    The total size is bounded by max_bytes; the least recently used bodies
+    (by file mtime, updated on every hit) are evicted first.
+    Safe to use from the download worker threads.
+    """
+    def __init__(self, folder: Path, max_bytes: int):
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.total_bytes = 0
+        for entry in os.scandir(self.folder):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith(".tmp"):
+                # Left by a put interrupted by a crash
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+                continue
+            self.total_bytes += entry.stat().st_size
+        self.hits = 0
+        self.misses = 0
+        if self.total_bytes > self.max_bytes:
+            with self.lock:
+                self._evict()
+
+    def _path(self, key: tuple) -> Path:
+        return self.folder / hashlib.sha256("/".join(str(part) for part in key).encode("utf-8")).hexdigest()
+
+    def get(self, key: tuple) -> AttachmentContent | None:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                content = AttachmentContent(iter(lambda: f.read(CHUNK_SIZE), b""))
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return None
+        try:
+            os.utime(path)  # mark as recently used
+        except OSError:
+            pass  # evicted in the meantime, the body is read anyway
+        with self.lock:
+            self.hits += 1
+        return content
+
+    def put(self, key: tuple, content: AttachmentContent):
+        if content.size > self.max_bytes:
+            return
+        path = self._path(key)
+        tmp_path = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+        with open(tmp_path, "wb") as f:
+            for chunk in content.chunks():
+                f.write(chunk)
+        with self.lock:
+            old_size = path.stat().st_size if path.exists() else 0
+            os.replace(tmp_path, path)
+            self.total_bytes += content.size - old_size
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Remove least recently used bodies until the cache fits into max_bytes (lock is held)."""
+        entries = sorted((entry for entry in os.scandir(self.folder)
+                          if entry.is_file() and not entry.name.endswith(".tmp")),
+                         key=lambda entry: entry.stat().st_mtime)
+        for entry in entries:
+            if self.total_bytes <= self.max_bytes:
+                break
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            self.total_bytes -= size
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "bytes": self.total_bytes}
+
+
+class ListingCache:
+    """In-process cache of /api/files/{obj} listings, shared by all fills.
+
+    Listings of status objects rarely change, so they are reused for ttl seconds.
+    At most max_entries listings are kept, the least recently used are dropped first.
+    Safe to use from the download worker threads.
+    """
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries: OrderedDict[str, tuple[float, list]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, obj_number) -> list | None:
+        key = str(obj_number)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, obj_number, listing: list):
+        with self.lock:
+            self.entries[str(obj_number)] = (time.monotonic(), listing)
+            self.entries.move_to_end(str(obj_number))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries)}
+
+
+_listing_cache = None
+_listing_cache_lock = threading.Lock()  # first use may come from several download workers at once
+
+def get_listing_cache() -> ListingCache | None:
+    """The shared listing cache, or None if attachments_listing_ttl is 0."""
+    global _listing_cache
+    ttl = config.loaded_config.attachments_listing_ttl
+    if not ttl:
+        return None
+    with _listing_cache_lock:
+        if _listing_cache is None:
+            _listing_cache = ListingCache(ttl, config.loaded_config.attachments_listing_max_entries)
+    return _listing_cache
+
+
+_attachment_disk_cache = None
+_attachment_disk_cache_lock = threading.Lock()  # first use may come from several download workers at once
+
+def get_attachment_disk_cache() -> AttachmentDiskCache | None:
+    """The shared disk cache, or None if attachments_cache_max_mb is 0."""
+    global _attachment_disk_cache
+    max_mb = config.loaded_config.attachments_cache_max_mb
+    if not max_mb:
+        return None
+    with _attachment_disk_cache_lock:
+        if _attachment_disk_cache is None:
+            _attachment_disk_cache = AttachmentDiskCache(config.ATTACHMENTS_CACHE_FOLDER, int(max_mb * 1024 * 1024))
+    return _attachment_disk_cache
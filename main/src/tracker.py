@@ -1,14 +1,233 @@
+from abc import ABC, abstractmethod
+from collections.abc import Iterable, Iterator, Mapping
+from contextlib import contextmanager
 import json
 import os
+import sqlite3
+import time
 from typing import Optional, Any
 
 
-class RecordTracker:
-    """Persistent tracker for rutmk_uid records using a JSON file."""
+# ParentNumbers of statusHistory objects (Kind=150002) of a rutmk_uid, with OCCode, OCDate and CreatedDate
+STATUS_HISTORY_QUERY = """
+    WITH obj AS (
+        SELECT object_uid FROM fips_rutrademark WHERE rutmk_uid = %s
+    ),
+    status_objects AS (
+        SELECT o2."Number" as parent_number
+        FROM "Objects" o1
+        JOIN "Objects" o2 ON o1."ParentNumber" = o2."ParentNumber"
+        WHERE o1."Number" = (SELECT object_uid FROM obj)
+          AND o2."Kind" = '150002'
+    )
+    SELECT
+        so.parent_number,
+        sa_code."TextValue" as occ_code,
+        sa_date."TextValue" as occ_date,
+        COALESCE(sa_code."CreatedDate", sa_date."CreatedDate") as created_date
+    FROM status_objects so
+    LEFT JOIN "SearchAttributes" sa_code
+        ON sa_code."ParentNumber" = so.parent_number AND sa_code."Name" = 'OCCode'
+    LEFT JOIN "SearchAttributes" sa_date
+        ON sa_date."ParentNumber" = so.parent_number AND sa_date."Name" = 'OCDate'
+"""
 
-    def __init__(self, file_path: str):
+
+def merge_status_history(existing: list[dict], rows: list[tuple]) -> list[dict]:
+    """
+    New status_history from the rows of STATUS_HISTORY_QUERY: existing entries are kept
+    (status unchanged), new ParentNumbers are added with status NEW, vanished ones are dropped.
+    """
+    current_parents = {}
+    for row in rows:
+        parent = str(row[0])
+        current_parents[parent] = {
+            'occ_code_raw': row[1],
+            'occ_date_raw': row[2],
+            'created_date': str(row[3]) if row[3] else None
+        }
+
+    existing_map = {entry["parent_number"]: entry for entry in existing}
+
+    new_history = []
+    for parent, extra in current_parents.items():
+        if parent in existing_map:
+            # keep existing entry (status unchanged)
+            new_history.append(existing_map[parent])
+        else:
+            # new statusHistory record with extra fields
+            new_entry = {
+                "parent_number": parent,
+                "status": "NEW",
+                "path_to_xml": None,
+                "error_text": None,
+                **extra
+            }
+            new_history.append(new_entry)
+    return new_history
+
+
+SCAN_PAGE_SIZE = 10000  # rows per keyset page of find_new_uids
+
+
+def find_new_uids(db_connector, date_col: str, start_date: str, known_uids, state: dict[str, Any],
+                  full_diff_interval: float) -> list[str]:
+    """
+    rutmk_uid of fips_rutrademark with date_col >= start_date that are not known yet.
+
+    Normally only the rows from the high-water mark date kept in state on are read, in pages ordered by
+    (date_col, rutmk_uid) (keyset pagination), whatever the number of known uids. The rows of the mark date
+    itself are read again and the known ones dropped: rutmk_uid is random, so a row added later on the same
+    date can sort before the ones already seen.
+    A full diff runs on the first scan, when start_date changes and every full_diff_interval seconds,
+    to catch rows that appear behind the mark (inserted late with an older date): the known uids are loaded
+    into a temporary table with COPY and anti-joined on the server.
+    state (a JSON-serializable dict persisted by the tracker) is updated in place.
+    """
+    rows = []
+    hwm = state.get("hwm_date")
+    full_diff = hwm is None or state.get("start_date") != str(start_date) or \
+                time.time() - state.get("full_diff_time", 0) >= full_diff_interval
+    if full_diff:
+        known_uids = list(known_uids)
+        if known_uids:
+            column_type = db_connector.get_column_type("fips_rutrademark", "rutmk_uid") or "text"
+            # The mark comes with the new rows (the NULL uid row), from the same statement and so the same snapshot:
+            # a row committed in between can not end up behind the mark without being returned
+            rows = db_connector.fetchall_with_values(
+                f"""
+                    SELECT NULL, max({date_col}) FROM fips_rutrademark WHERE {date_col} >= %s
+                    UNION ALL
+                    SELECT t.rutmk_uid, t.{date_col} FROM fips_rutrademark t
+                    WHERE t.{date_col} >= %s
+                      AND NOT EXISTS (SELECT 1 FROM known_uids k WHERE k.value = t.rutmk_uid)
+                """,
+                (start_date, start_date), "known_uids", column_type, known_uids
+            )
+        else:
+            rows = db_connector.fetchall(
+                f"SELECT rutmk_uid, {date_col} FROM fips_rutrademark WHERE {date_col} >= %s", (start_date,))
+        last = max((row[1] for row in rows if row[1] is not None), default=None)
+        hwm = str(last) if last is not None else None
+        rows = [row for row in rows if row[0] is not None]
+        state["full_diff_time"] = time.time()
+    elif hwm is not None:
+        keyset = ""  # the rows after the last one of the previous page
+        params = (hwm,)
+        last_date = None  # of the last row read, the next mark
+        while True:
+            page = db_connector.fetchall(
+                f"""
+                    SELECT rutmk_uid, {date_col} FROM fips_rutrademark
+                    WHERE {date_col} >= %s {keyset}
+                    ORDER BY {date_col}, rutmk_uid LIMIT %s
+                """,
+                (*params, SCAN_PAGE_SIZE)
+            )
+            rows.extend(row for row in page if row[0] not in known_uids)
+            if page:
+                last_date = page[-1][1]
+            if len(page) < SCAN_PAGE_SIZE:
+                break
+            keyset = f"AND ({date_col}, rutmk_uid) > (%s, %s)"
+            params = (hwm, page[-1][1], page[-1][0])
+        if last_date is not None:
+            hwm = str(last_date)
+    state["hwm_date"] = hwm
+    state.pop("hwm", None)  # (date, rutmk_uid) mark of the former keyset
+    state["start_date"] = str(start_date)
+    return [row[0] for row in rows]
+
+
+class TrackerBatching(ABC):
+    """
+    `with tracker.batch():` for the trackers: updates inside are applied at once but persisted
+    with one flush when the outermost batch ends. With max_interval (seconds) pending updates are also
+    flushed by the first update after they have waited that long, so a crash loses at most max_interval of work.
+    `for item in tracker.batched(items, size):` runs a batch per `size` items, so a crash loses at most
+    the updates of one group (or max_interval of work, whichever is less).
+    The tracker provides flush(), and calls _flush_if_due() after every update.
+    """
+    batch_depth = 0
+    batch_max_interval = None
+    flush_deadline = None
+
+    @contextmanager
+    def batch(self, max_interval: float = None):
+        self.batch_depth += 1
+        if self.batch_depth == 1:
+            self.batch_max_interval = max_interval
+        try:
+            yield self
+        finally:
+            self.batch_depth -= 1
+            if not self.batch_depth:
+                self.flush()
+
+    def batched(self, items: Iterable, size: int, max_interval: float = None) -> Iterator:
+        """Yield the items, the tracker updates made while processing every `size` of them are one batch."""
+        items = iter(items)
+        while True:
+            with self.batch(max_interval):
+                count = 0
+                for item in items:
+                    yield item
+                    count += 1
+                    if count >= size:
+                        break
+                else:
+                    return
+
+    def _flush_if_due(self):
+        if self.batch_depth:
+            if self.batch_max_interval is None:
+                return
+            now = time.monotonic()
+            if self.flush_deadline is None:
+                self.flush_deadline = now + self.batch_max_interval
+                return
+            if now < self.flush_deadline:
+                return
+        self.flush()
+
+    @abstractmethod
+    def flush(self):
+        """Persist the pending updates."""
+
+
+class RecordTracker(TrackerBatching):
+    """
+    Persistent tracker for rutmk_uid records using a JSON file.
+
+    Updates are appended as JSON-lines deltas to a journal next to the file ({file_path}.journal)
+    instead of rewriting the whole tracker: the JSON file is a snapshot, and the tracker is the snapshot
+    with the journal replayed. save() writes a fresh snapshot and empties the journal; it runs after every
+    scan and whenever the journal grows past journal_max_bytes. Deltas carry the new values only,
+    so replaying them over a snapshot that already contains them changes nothing.
+    journal_max_bytes=0 disables the journal, every update rewrites the file.
+
+    The tracker keeps in-memory indexes (record status -> uids, status_history entry status -> uids),
+    updated by every mutation, so the steps look up the actionable records without scanning all of them.
+    """
+
+    def __init__(self, file_path: str, journal_max_bytes: int = 0):
         self.file_path = file_path
+        self.journal_path = f"{file_path}.journal"
+        self.scan_state_path = f"{file_path}.scan.json"
+        self.journal_max_bytes = journal_max_bytes
+        self.journal = None
+        self.pending: list[str] = []  # journal lines not flushed yet
+        self.unsaved = False  # without the journal: the file is behind self.data
+        self.positions: dict[str, int] = {}  # uid -> position in self.data, lookups return records in tracker order
+        self.records_by_status: dict[Any, set[str]] = {}
+        self.entries_by_status: dict[Any, dict[str, int]] = {}  # entry status -> {uid: number of its entries}
+        self.indexed: dict[str, tuple[Any, list]] = {}  # uid -> (record status, entry statuses) in the indexes
         self.data: dict[str, dict[str, Any]] = self._load()
+        for uid in self.data:
+            self._index(uid)
+        self._replay_journal()
+        if self.journal_max_bytes:
+            self.journal = open(self.journal_path, 'a', encoding="utf-8")
 
     def _load(self) -> dict[str, dict[str, Any]]:
         if os.path.exists(self.file_path):
@@ -16,40 +235,127 @@ class RecordTracker:
                 return json.load(f)
         return {}
 
+    def _replay_journal(self):
+        if not os.path.exists(self.journal_path):
+            return
+        replayed = 0  # bytes of complete deltas
+        with open(self.journal_path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # torn last line of an interrupted write
+                try:
+                    delta = json.loads(line)
+                except ValueError:
+                    break
+                self._apply(delta)
+                replayed += len(line)
+            torn = f.seek(0, os.SEEK_END) > replayed
+        if torn:
+            # Cut the torn tail off, or the next deltas appended after it would be lost with it on the next replay
+            os.truncate(self.journal_path, replayed)
+
     def save(self):
-        with open(self.file_path, 'w', encoding="utf-8") as f:
+        """Write a snapshot of the tracker (atomically) and empty the journal."""
+        tmp_path = f"{self.file_path}.tmp"
+        with open(tmp_path, 'w', encoding="utf-8") as f:
             json.dump(self.data, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, self.file_path)
+        self.pending = []
+        self.unsaved = False
+        self.flush_deadline = None
+        if self.journal is not None:
+            self.journal.seek(0)
+            self.journal.truncate()
+        elif os.path.exists(self.journal_path):
+            os.remove(self.journal_path)  # the journal was switched off, its deltas are in the snapshot now
 
-    def scan_new_records(self, db_connector, date_col: str, start_date: str):
+    def backup(self, path: str):
+        with open(path, 'w', encoding="utf-8") as f:
+            json.dump(self.data, f, indent=2, ensure_ascii=False)
+
+    def _commit(self, delta: dict[str, Any]):
+        """Apply the delta and persist it (see flush), now or at the end of the batch."""
+        self._apply(delta)
+        if self.journal is not None:
+            self.pending.append(json.dumps(delta, ensure_ascii=False) + "\n")
+        else:
+            self.unsaved = True
+        self._flush_if_due()
+
+    def flush(self):
+        """Append the pending deltas to the journal with one write and fsync, or rewrite the file without one."""
+        self.flush_deadline = None
+        if self.journal is None:
+            if self.unsaved:
+                self.save()
+            return
+        if not self.pending:
+            return
+        self.journal.write("".join(self.pending))
+        self.pending = []
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        if self.journal.tell() > self.journal_max_bytes:
+            self.save()
+
+    def _index(self, uid: str):
+        record = self.data.get(uid)
+        if record is None:
+            return
+        self.positions.setdefault(uid, len(self.positions))
+        status = record.get("status")
+        entry_statuses = [entry.get("status") for entry in record.get("status_history", [])]
+        self.records_by_status.setdefault(status, set()).add(uid)
+        for entry_status in entry_statuses:
+            uids = self.entries_by_status.setdefault(entry_status, {})
+            uids[uid] = uids.get(uid, 0) + 1
+        self.indexed[uid] = (status, entry_statuses)
+
+    def _unindex(self, uid: str):
+        if uid not in self.indexed:
+            return
+        status, entry_statuses = self.indexed.pop(uid)
+        self.records_by_status[status].discard(uid)
+        for entry_status in entry_statuses:
+            uids = self.entries_by_status[entry_status]
+            uids[uid] -= 1
+            if not uids[uid]:
+                del uids[uid]
+
+    def _apply(self, delta: dict[str, Any]):
+        self._unindex(delta["uid"])
+        try:
+            self._apply_delta(delta)
+        finally:
+            self._index(delta["uid"])
+
+    def _apply_delta(self, delta: dict[str, Any]):
+        op, uid = delta["op"], delta["uid"]
+        if op == "record":
+            self._apply_record_update(uid, delta["fields"])
+        elif op == "entry":
+            self._apply_entry_update(uid, delta["parent_number"], delta["fields"])
+        elif op == "update_seq":
+            self.data.setdefault(uid, {})["update_seq"] = delta["value"]
+        else:
+            raise Exception(f"Unknown tracker journal operation: {op}")
+
+    def scan_new_records(self, db_connector, date_col: str, start_date: str, full_diff_interval: float = 24 * 3600):
         """
-        Query database for rutmk_uid where date_col >= start_date and not already in tracker.
+        Query database for rutmk_uid where date_col >= start_date and not already in tracker
+        (see find_new_uids, the scan state is kept in {file_path}.scan.json).
         Add them with status "NEW".
         Also fetch associated status‑history ParentNumbers and add them as status_history entries.
         """
-        existing_uids = list(self.data.keys())
-        if existing_uids:
-            placeholders = ','.join(['%s'] * len(existing_uids))
-            query = f"""
-                SELECT rutmk_uid FROM fips_rutrademark
-                WHERE {date_col} >= %s AND rutmk_uid NOT IN ({placeholders})
-            """
-            params = [start_date] + existing_uids
-        else:
-            query = f"""
-                SELECT rutmk_uid FROM fips_rutrademark
-                WHERE {date_col} >= %s
-            """
-            params = [start_date]
-
-        rows = db_connector.fetchall(query, params)
-        for row in rows:
-            uid = row[0]
+        state = self._load_scan_state()
+        for uid in find_new_uids(db_connector, date_col, start_date, self.data.keys(), state, full_diff_interval):
             if uid not in self.data:
                 # initialise main record
                 self.data[uid] = {
                     "status": "NEW",
                     "status_history": []   # will be filled below
                 }
+                self._index(uid)
 
         # Now for each rutmk_uid (new or existing) we need to ensure its status_history
         # is up‑to‑date. We'll do it for all uids to catch newly added statuses later.
@@ -60,70 +366,41 @@ class RecordTracker:
             self._refresh_status_history(db_connector, uid)
 
         self.save()
+        # After the records: if the state is lost, the next scan just finds known uids again
+        tmp_path = f"{self.scan_state_path}.tmp"
+        with open(tmp_path, 'w', encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.scan_state_path)
+
+    def _load_scan_state(self) -> dict[str, Any]:
+        if os.path.exists(self.scan_state_path):
+            with open(self.scan_state_path, 'r', encoding="utf-8") as f:
+                try:
+                    return json.load(f)
+                except json.JSONDecodeError:
+                    return {}  # broken state, the next scan is a full diff
+        return {}
 
     def _refresh_status_history(self, db_connector, uid: str):
         """Query the database for current ParentNumbers of statusHistory (Kind=150002) for this uid,
         along with OCCode, OCDate and CreatedDate."""
-        query = """
-            WITH obj AS (
-                SELECT object_uid FROM fips_rutrademark WHERE rutmk_uid = %s
-            ),
-            status_objects AS (
-                SELECT o2."Number" as parent_number
-                FROM "Objects" o1
-                JOIN "Objects" o2 ON o1."ParentNumber" = o2."ParentNumber"
-                WHERE o1."Number" = (SELECT object_uid FROM obj)
-                  AND o2."Kind" = '150002'
-            )
-            SELECT
-                so.parent_number,
-                sa_code."TextValue" as occ_code,
-                sa_date."TextValue" as occ_date,
-                COALESCE(sa_code."CreatedDate", sa_date."CreatedDate") as created_date
-            FROM status_objects so
-            LEFT JOIN "SearchAttributes" sa_code
-                ON sa_code."ParentNumber" = so.parent_number AND sa_code."Name" = 'OCCode'
-            LEFT JOIN "SearchAttributes" sa_date
-                ON sa_date."ParentNumber" = so.parent_number AND sa_date."Name" = 'OCDate'
-        """
-        rows = db_connector.fetchall(query, (uid,))
-        current_parents = {}
-        for row in rows:
-            parent = str(row[0])
-            current_parents[parent] = {
-                'occ_code_raw': row[1],
-                'occ_date_raw': row[2],
-                'created_date': str(row[3]) if row[3] else None
-            }
-
-        # Get existing status_history from tracker
+        rows = db_connector.fetchall(STATUS_HISTORY_QUERY, (uid,))
         existing = self.data[uid].get("status_history", [])
-        existing_map = {entry["parent_number"]: entry for entry in existing}
-
-        new_history = []
-        for parent, extra in current_parents.items():
-            if parent in existing_map:
-                # keep existing entry (status unchanged)
-                new_history.append(existing_map[parent])
-            else:
-                # new statusHistory record with extra fields
-                new_entry = {
-                    "parent_number": parent,
-                    "status": "NEW",
-                    "path_to_xml": None,
-                    "error_text": None,
-                    **extra
-                }
-                new_history.append(new_entry)
-        self.data[uid]["status_history"] = new_history
+        self._unindex(uid)
+        self.data[uid]["status_history"] = merge_status_history(existing, rows)
+        self._index(uid)
+
+    def _in_order(self, uids: set[str]) -> list[tuple]:
+        return [(uid, self.data[uid]) for uid in sorted(uids, key=self.positions.__getitem__)]
 
     def get_records_by_status(self, *statuses: str) -> list[tuple]:
         """Return list of (uid, record) for records whose overall status is in statuses."""
-        result = []
-        for uid, rec in self.data.items():
-            if rec.get("status") in statuses:
-                result.append((uid, rec))
-        return result
+        return self._in_order(set().union(*(self.records_by_status.get(status, ()) for status in statuses)))
+
+    def get_records_with_entries(self, record_status: str, *entry_statuses: str) -> list[tuple]:
+        """Return list of (uid, record) for records in record_status having status_history entries in entry_statuses."""
+        uids = set().union(*(self.entries_by_status.get(status, {}).keys() for status in entry_statuses))
+        return self._in_order(uids & self.records_by_status.get(record_status, set()))
 
     def get_status_history_entries_by_status(self, uid: str, *statuses: str) -> list[dict]:
         """Return list of status_history entries for the given uid whose status is in statuses."""
@@ -132,21 +409,26 @@ class RecordTracker:
 
     def update_record(self, uid: str, **kwargs):
         """Update fields for a main record. If the record does not exist, it is created."""
+        self._commit({"op": "record", "uid": uid, "fields": kwargs})
+
+    def _apply_record_update(self, uid: str, fields: dict[str, Any]):
         if uid not in self.data:
             self.data[uid] = {}
-        self.data[uid].update(kwargs)
+        self.data[uid].update(fields)
         # remove keys with None value
         self.data[uid] = {k: v for k, v in self.data[uid].items() if v is not None}
-        self.save()
 
     def update_status_history_entry(self, uid: str, parent_number: str, **kwargs):
         """Update a specific status_history entry."""
+        self._commit({"op": "entry", "uid": uid, "parent_number": parent_number, "fields": kwargs})
+
+    def _apply_entry_update(self, uid: str, parent_number: str, fields: dict[str, Any]):
         if uid not in self.data:
             self.data[uid] = {"status_history": []}
         history = self.data[uid].setdefault("status_history", [])
         for entry in history:
             if entry["parent_number"] == parent_number:
-                entry.update(kwargs)
+                entry.update(fields)
                 # remove keys with None
                 for k in list(entry.keys()):
                     if entry[k] is None:
@@ -155,9 +437,8 @@ class RecordTracker:
         else:
             # not found – add new
             new_entry = {"parent_number": parent_number}
-            new_entry.update(kwargs)
+            new_entry.update(fields)
             history.append(new_entry)
-        self.save()
 
     def get_elk_order_number(self, uid: str) -> Optional[str]:
         return self.data.get(uid, {}).get("elkOrderNumber", None)
@@ -169,10 +450,245 @@ class RecordTracker:
         return self.data.get(uid, {}).get("update_seq", 0)
 
     def increment_update_seq(self, uid: str) -> int:
-        if uid not in self.data:
-            self.data[uid] = {}
-        seq = self.data[uid].get("update_seq", 0) + 10
-        self.data[uid]["update_seq"] = seq
-        self.save()
+        seq = self.get_update_seq(uid) + 10
+        self._commit({"op": "update_seq", "uid": uid, "value": seq})
         return seq
 
+
+
+class SQLiteRecordsView(Mapping):
+    """
+    Read-only {uid: record} view of SQLiteRecordTracker, in the shape of RecordTracker.data.
+    Iteration takes a snapshot of the uids, so records can be updated while iterating;
+    every record is loaded when it is reached.
+    """
+    def __init__(self, tracker: "SQLiteRecordTracker"):
+        self.tracker = tracker
+
+    def __getitem__(self, uid: str) -> dict[str, Any]:
+        record = self.tracker._load_record(uid)
+        if record is None:
+            raise KeyError(uid)
+        return record
+
+    def __iter__(self) -> Iterator[str]:
+        rows = self.tracker.connection.execute("SELECT uid FROM records ORDER BY rowid").fetchall()
+        return iter([row[0] for row in rows])
+
+    def __len__(self) -> int:
+        return self.tracker.connection.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+    def __contains__(self, uid: object) -> bool:
+        return self.tracker.connection.execute("SELECT 1 FROM records WHERE uid = ?", (uid,)).fetchone() is not None
+
+
+class SQLiteRecordTracker(TrackerBatching):
+    """
+    Persistent tracker for rutmk_uid records in an SQLite database (WAL mode), with the public methods
+    of RecordTracker. Records and status_history entries are rows with an indexed status column
+    and the other fields as JSON, so an update writes one row instead of the whole tracker.
+    Records and entries returned by the getters are copies, changes go through the update_* methods.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS records (
+            uid TEXT PRIMARY KEY,
+            status TEXT,
+            fields TEXT NOT NULL DEFAULT '{}'
+        );
+        CREATE INDEX IF NOT EXISTS records_status ON records (status);
+        CREATE TABLE IF NOT EXISTS status_history (
+            uid TEXT NOT NULL,
+            parent_number TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            status TEXT,
+            fields TEXT NOT NULL DEFAULT '{}',
+            PRIMARY KEY (uid, parent_number)
+        );
+        CREATE INDEX IF NOT EXISTS status_history_status ON status_history (status, uid);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.connection = sqlite3.connect(file_path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")  # durable at checkpoints, consistent always
+        self.connection.executescript(self.SCHEMA)
+        self.data = SQLiteRecordsView(self)
+
+    def save(self):
+        self.flush()
+
+    def flush(self):
+        self.flush_deadline = None
+        self.connection.commit()
+
+    def backup(self, path: str):
+        with sqlite3.connect(path) as target:
+            self.connection.backup(target)
+        target.close()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def import_json(self, json_path: str):
+        """One-shot import of a RecordTracker JSON file (and its journal), replacing everything in the database."""
+        data = RecordTracker(json_path).data
+        self.connection.execute("DELETE FROM records")
+        self.connection.execute("DELETE FROM status_history")
+        self.connection.executemany(
+            "INSERT INTO records (uid, status, fields) VALUES (?, ?, ?)",
+            ((uid, rec.get("status"), self._dump_fields(rec, ("status", "status_history")))
+             for uid, rec in data.items()))
+        self.connection.executemany(
+            "INSERT INTO status_history (uid, parent_number, position, status, fields) VALUES (?, ?, ?, ?, ?)",
+            ((uid, entry["parent_number"], position, entry.get("status"),
+              self._dump_fields(entry, ("parent_number", "status")))
+             for uid, rec in data.items()
+             for position, entry in enumerate(rec.get("status_history", []))))
+        self.save()
+
+    @staticmethod
+    def _dump_fields(item: dict[str, Any], columns: tuple[str, ...]) -> str:
+        return json.dumps({k: v for k, v in item.items() if k not in columns}, ensure_ascii=False)
+
+    @staticmethod
+    def _entry(parent_number: str, status: Optional[str], fields: str) -> dict[str, Any]:
+        entry = {"parent_number": parent_number}
+        if status is not None:
+            entry["status"] = status
+        entry.update(json.loads(fields))
+        return entry
+
+    def _load_history(self, uid: str) -> list[dict]:
+        rows = self.connection.execute(
+            "SELECT parent_number, status, fields FROM status_history WHERE uid = ? ORDER BY position", (uid,))
+        return [self._entry(*row) for row in rows]
+
+    def _load_record(self, uid: str) -> Optional[dict[str, Any]]:
+        row = self.connection.execute("SELECT status, fields FROM records WHERE uid = ?", (uid,)).fetchone()
+        if row is None:
+            return None
+        record = {"status": row[0]} if row[0] is not None else {}
+        record.update(json.loads(row[1]))
+        record["status_history"] = self._load_history(uid)
+        return record
+
+    def _write_history(self, uid: str, history: list[dict]):
+        self.connection.execute("DELETE FROM status_history WHERE uid = ?", (uid,))
+        self.connection.executemany(
+            "INSERT INTO status_history (uid, parent_number, position, status, fields) VALUES (?, ?, ?, ?, ?)",
+            ((uid, entry["parent_number"], position, entry.get("status"),
+              self._dump_fields(entry, ("parent_number", "status")))
+             for position, entry in enumerate(history)))
+
+    def scan_new_records(self, db_connector, date_col: str, start_date: str, full_diff_interval: float = 24 * 3600):
+        """
+        Query database for rutmk_uid where date_col >= start_date and not already in tracker (see find_new_uids).
+        Add them with status "NEW" and refresh the status_history of all records (see RecordTracker).
+        """
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'scan_state'").fetchone()
+        state = json.loads(row[0]) if row is not None else {}
+        new_uids = find_new_uids(db_connector, date_col, start_date, self.data, state, full_diff_interval)
+        self.connection.executemany("INSERT OR IGNORE INTO records (uid, status) VALUES (?, 'NEW')",
+                                    ((uid,) for uid in new_uids))
+
+        for uid in list(self.data):
+            self._refresh_status_history(db_connector, uid)
+
+        self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('scan_state', ?)", (json.dumps(state),))
+        self.save()
+
+    def _refresh_status_history(self, db_connector, uid: str):
+        """Query the database for current ParentNumbers of statusHistory (Kind=150002) for this uid,
+        along with OCCode, OCDate and CreatedDate."""
+        rows = db_connector.fetchall(STATUS_HISTORY_QUERY, (uid,))
+        self._write_history(uid, merge_status_history(self._load_history(uid), rows))
+
+    def get_records_by_status(self, *statuses: str) -> list[tuple]:
+        """Return list of (uid, record) for records whose overall status is in statuses."""
+        placeholders = ','.join(['?'] * len(statuses))
+        rows = self.connection.execute(
+            f"SELECT uid FROM records WHERE status IN ({placeholders}) ORDER BY rowid", statuses).fetchall()
+        return [(uid, self._load_record(uid)) for uid, in rows]
+
+    def get_records_with_entries(self, record_status: str, *entry_statuses: str) -> list[tuple]:
+        """Return list of (uid, record) for records in record_status having status_history entries in entry_statuses."""
+        placeholders = ','.join(['?'] * len(entry_statuses))
+        rows = self.connection.execute(
+            f"SELECT uid FROM records WHERE status = ? AND uid IN "
+            f"(SELECT uid FROM status_history WHERE status IN ({placeholders})) ORDER BY rowid",
+            (record_status, *entry_statuses)).fetchall()
+        return [(uid, self._load_record(uid)) for uid, in rows]
+
+    def get_status_history_entries_by_status(self, uid: str, *statuses: str) -> list[dict]:
+        """Return list of status_history entries for the given uid whose status is in statuses."""
+        placeholders = ','.join(['?'] * len(statuses))
+        rows = self.connection.execute(
+            f"SELECT parent_number, status, fields FROM status_history "
+            f"WHERE uid = ? AND status IN ({placeholders}) ORDER BY position", (uid, *statuses))
+        return [self._entry(*row) for row in rows]
+
+    def update_record(self, uid: str, **kwargs):
+        """Update fields for a main record. If the record does not exist, it is created."""
+        row = self.connection.execute("SELECT status, fields FROM records WHERE uid = ?", (uid,)).fetchone()
+        record = {}
+        if row is not None:
+            if row[0] is not None:
+                record["status"] = row[0]
+            record.update(json.loads(row[1]))
+        record.update(kwargs)
+        # remove keys with None value
+        record = {k: v for k, v in record.items() if v is not None}
+        self.connection.execute(
+            "INSERT INTO records (uid, status, fields) VALUES (?, ?, ?) "
+            "ON CONFLICT (uid) DO UPDATE SET status = excluded.status, fields = excluded.fields",
+            (uid, record.get("status"), self._dump_fields(record, ("status", "status_history"))))
+        self._flush_if_due()
+
+    def update_status_history_entry(self, uid: str, parent_number: str, **kwargs):
+        """Update a specific status_history entry."""
+        self.connection.execute("INSERT OR IGNORE INTO records (uid) VALUES (?)", (uid,))
+        row = self.connection.execute(
+            "SELECT status, fields FROM status_history WHERE uid = ? AND parent_number = ?",
+            (uid, parent_number)).fetchone()
+        if row is not None:
+            entry = self._entry(parent_number, *row)
+            entry.update(kwargs)
+            # remove keys with None
+            entry = {k: v for k, v in entry.items() if v is not None}
+            self.connection.execute(
+                "UPDATE status_history SET status = ?, fields = ? WHERE uid = ? AND parent_number = ?",
+                (entry.get("status"), self._dump_fields(entry, ("parent_number", "status")), uid, parent_number))
+        else:
+            # not found – add new
+            new_entry = {"parent_number": parent_number}
+            new_entry.update(kwargs)
+            self.connection.execute(
+                "INSERT INTO status_history (uid, parent_number, position, status, fields) "
+                "VALUES (?, ?, (SELECT COALESCE(MAX(position) + 1, 0) FROM status_history WHERE uid = ?), ?, ?)",
+                (uid, parent_number, uid, new_entry.get("status"),
+                 self._dump_fields(new_entry, ("parent_number", "status"))))
+        self._flush_if_due()
+
+    def _get_field(self, uid: str, key: str) -> Any:
+        row = self.connection.execute("SELECT fields FROM records WHERE uid = ?", (uid,)).fetchone()
+        return None if row is None else json.loads(row[0]).get(key)
+
+    def get_elk_order_number(self, uid: str) -> Optional[str]:
+        return self._get_field(uid, "elkOrderNumber")
+
+    def get_create_request_id(self, uid: str) -> Optional[str]:
+        return self._get_field(uid, "createRequestId")
+
+    def get_update_seq(self, uid: str) -> int:
+        return self._get_field(uid, "update_seq") or 0
+
+    def increment_update_seq(self, uid: str) -> int:
+        seq = self.get_update_seq(uid) + 10
+        self.update_record(uid, update_seq=seq)
+        return seq
@@ -39,6 +39,9 @@ class SingleThreadedTunnelManager:
         self.db_appl_tunnel = None
         self.db_appl_pool = None
 
+        # Shared keep-alive session for API calls
+        self.api_http_session = None
+
         # Fixed local ports
         self.API_LOCAL_PORT = loaded_config.api_bind_port  # from config
         self.DB_ADAPTER_LOCAL_PORT = 15432
@@ -83,6 +86,10 @@ class SingleThreadedTunnelManager:
             return self.api_tunnel
 
         self._stop_tunnels(self.api_tunnel, self.jump_tunnel_api)
+        # Pooled connections went through the old tunnel
+        if self.api_http_session is not None:
+            self.api_http_session.close()
+            self.api_http_session = None
 
         jump_tunnel = SSHTunnelForwarder(
             (loaded_config.proxy_ip, 22),
@@ -103,6 +110,17 @@ class SingleThreadedTunnelManager:
         self.jump_tunnel_api = jump_tunnel
         return self.api_tunnel
 
+    def api_session(self) -> requests.Session:
+        """Shared keep-alive session for API calls (use inside api_connection).
+        Its connection pool is sized for attachments_concurrency worker threads."""
+        if self.api_http_session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(1, loaded_config.attachments_concurrency))
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self.api_http_session = session
+        return self.api_http_session
+
     @contextmanager
     def api_connection(self):
         """Context manager for API calls"""
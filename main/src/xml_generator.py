@@ -1,98 +1,217 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+import hashlib
+import io
+import multiprocessing
 import os
-from typing import Any
-from xml.dom import minidom
+import pickle
+from typing import Any, Callable, TextIO
+from urllib.parse import urlparse
+from urllib.request import url2pathname
 import xml.etree.ElementTree as ET
 import xmlschema
 
+from src.logger import logger
+from src.xsd_facets import FacetChecker
+
+
+NAMESPACE = "http://epgu.gosuslugi.ru/elk/status/1.0.2"
+NAMESPACE_PREFIX = "ns0"  # the prefix ElementTree assigns to NAMESPACE
+XML_DECLARATION = '<?xml version="1.0" encoding="utf-8"?>'
+
+
+@lru_cache(maxsize=None)
+def _qname(tag: str) -> str:
+    return f"{NAMESPACE_PREFIX}:{tag}"
+
+
+def _escape(value: Any) -> str:
+    # Same escaping as minidom uses for both text and attribute values
+    return str(value).replace("&", "&amp;").replace("<", "&lt;").replace("\"", "&quot;").replace(">", "&gt;")
+
+
+def _parsed_text(text: str) -> str:
+    # Text as a parser reads it back from _escape(text): line breaks are normalized
+    return text.replace("\r\n", "\n").replace("\r", "\n")
+
+
+def _parsed_attribute(value: Any) -> str:
+    # Attribute value as a parser reads it back: whitespace characters become spaces
+    return _parsed_text(str(value)).replace("\n", " ").replace("\t", " ")
+
+
+def _file_digest(path: str) -> str:
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError as e:
+        raise Exception(f"Could not read XSD file {path}: {e}")
+
+
+def _schema_files(schema: xmlschema.XMLSchema) -> list[str]:
+    """Absolute paths of the local files of the schema and of everything it includes or imports
+    (the meta-schemas shipped with xmlschema are left out, they change with its version)."""
+    package = os.path.dirname(os.path.abspath(xmlschema.__file__)) + os.sep
+    paths = []
+    for loaded in schema.maps.iter_schemas():
+        if loaded.url and loaded.url.startswith("file:"):
+            path = os.path.abspath(url2pathname(urlparse(loaded.url).path))
+            if not path.startswith(package):
+                paths.append(path)
+    return paths
+
 
 class XMLGenerator:
-    def __init__(self, xsd_path: str = "schemas.xsd"):
+    def __init__(self, xsd_path: str = "schemas.xsd", cache_path: str = None):
         self.xsd_path = xsd_path
+        self.cache_path = cache_path
         self.schema = None
+        self.facets = None
 
         if os.path.exists(xsd_path):
             try:
-                self.schema = xmlschema.XMLSchema(xsd_path)
+                self.schema = self._load_schema(xsd_path, cache_path)
             except Exception as e:
                 raise Exception(f"Could not load XSD schema")
+            self.facets = FacetChecker(self.schema)
 
-    def _create_element_with_ns(self, tag: str, text: str = None,
-                               attributes: dict[str, str] = None) -> ET.Element:
-        ns = "http://epgu.gosuslugi.ru/elk/status/1.0.2"
-        element = ET.Element(f"{{{ns}}}{tag}")
+    @staticmethod
+    def _load_schema(xsd_path: str, cache_path: str = None) -> xmlschema.XMLSchema:
+        """
+        Build the schema, or load it from cache_path (a pickle of the compiled schema)
+        if the cache was made by the same xmlschema version from the same xsd_path and the same
+        contents of every file it includes or imports. The cache is (re)written whenever the schema has to be built.
+        """
+        if cache_path is not None and os.path.exists(cache_path):
+            try:
+                with open(cache_path, "rb") as f:
+                    # The key is stored first, so a stale schema is not unpickled at all
+                    version, digests = pickle.load(f)
+                    if version == xmlschema.__version__ and os.path.abspath(xsd_path) in digests and \
+                            all(os.path.exists(path) and _file_digest(path) == digest for path, digest in digests.items()):
+                        return pickle.load(f)
+            except Exception as e:
+                logger.log(f"WARNING: could not read the schema cache {cache_path}, rebuilding it: {e}", force_print=True)
 
-        if text is not None:
-            element.text = str(text)
+        schema = xmlschema.XMLSchema(xsd_path)
+        if cache_path is not None:
+            try:
+                digests = {path: _file_digest(path) for path in _schema_files(schema)}
+                tmp_path = f"{cache_path}.tmp"
+                with open(tmp_path, "wb") as f:
+                    pickle.dump((xmlschema.__version__, digests), f)
+                    pickle.dump(schema, f)
+                os.replace(tmp_path, cache_path)
+            except Exception as e:
+                # The cache only speeds up the next start
+                logger.log(f"WARNING: could not write the schema cache {cache_path}: {e}", force_print=True)
+        return schema
 
-        if attributes:
-            for key, value in attributes.items():
-                element.set(key, str(value))
+    def check_facets(self, json_data: dict[str, Any], root_tag: str = "ElkOrderRequest") -> list[str]:
+        """
+        Fast pre-validation of the filled template against the XSD simple-type facets
+        (length, pattern, enumeration, ranges, date/dateTime...), before any XML is built.
+        Returns the violations with their paths; an empty list does not make the document valid.
+        """
+        if self.facets is None:
+            return []
+        return self.facets.check(json_data, root_tag)
 
-        return element
+    def json_to_xml(self, json_data: dict[str, Any],
+                         root_tag: str = "ElkOrderRequest", pretty: bool = True) -> str:
+        out = io.StringIO()
+        self.write_xml(json_data, out, root_tag, pretty)
+        return out.getvalue()
 
-    def _dict_to_xml(self, parent: ET.Element, data: dict[str, Any],
-                    is_root: bool = False):
-        # if is_root:
-        #     parent.set("xmlns", "http://epgu.gosuslugi.ru/elk/status/1.0.2")
+    def json_to_xml_tree(self, json_data: dict[str, Any],
+                         root_tag: str = "ElkOrderRequest", pretty: bool = True) -> tuple[str, ET.Element]:
+        """json_to_xml, also returning the document as an element tree built in the same walk (for validate)."""
+        out = io.StringIO()
+        builder = ET.TreeBuilder()
+        self.write_xml(json_data, out, root_tag, pretty, builder)
+        return out.getvalue(), builder.close()
 
+    def write_xml(self, json_data: dict[str, Any], out: TextIO,
+                  root_tag: str = "ElkOrderRequest", pretty: bool = True, builder: ET.TreeBuilder = None):
+        """
+        Serialize the filled template straight to out (a text file or buffer), walking it once.
+        `_` keys are skipped (debug metadata), `@` keys are attributes, `#text` is the text,
+        lists repeat the tag. pretty=True indents by 2 spaces (the same document as the former
+        ElementTree + minidom output, see benchmarks/bench_xml.py), pretty=False writes no
+        whitespace between tags.
+        With builder the same elements are also fed to it (without the indentation), so builder.close()
+        gives the tree a parser would read back from the output, without parsing it.
+        """
+        newl = "\n" if pretty else ""
+        try:
+            out.write(XML_DECLARATION + newl)
+            self._write_element(out.write, builder, root_tag, json_data, "", "  " if pretty else "", newl,
+                                f' xmlns:{NAMESPACE_PREFIX}="{NAMESPACE}"')
+        except Exception as e:
+            raise Exception(f"Error creating XML file")
+
+    def _write_element(self, write, builder: ET.TreeBuilder | None, tag: str, data: Any,
+                       indent: str, addindent: str, newl: str, namespace_declaration: str = ""):
+        qname = _qname(tag)
+        if not isinstance(data, dict):
+            text = str(data)
+            if builder is not None:
+                builder.start(f"{{{NAMESPACE}}}{tag}", {})
+                if text:
+                    builder.data(_parsed_text(text))
+                builder.end(f"{{{NAMESPACE}}}{tag}")
+            if text:
+                write(f"{indent}<{qname}{namespace_declaration}>{_escape(text)}</{qname}>{newl}")
+            else:
+                write(f"{indent}<{qname}{namespace_declaration}/>{newl}")
+            return
+
+        attributes = {}
+        text = None
+        children = []
         for key, value in data.items():
             if key.startswith('_'):  # Debug metadata, skip
                 continue
             if key.startswith('@'):  # Attribute
-                attr_name = key[1:]
-                parent.set(attr_name, str(value))
+                attributes[key[1:]] = value
             elif key == '#text':  # Text content
-                parent.text = str(value)
-            elif isinstance(value, dict):
-                # Create child element and process nested dict
-                child = self._create_element_with_ns(key)
-                self._dict_to_xml(child, value)
-                parent.append(child)
+                text = str(value)
             elif isinstance(value, list):
-                # Handle lists - create multiple elements with same tag
-                for item in value:
-                    if isinstance(item, dict):
-                        child = self._create_element_with_ns(key)
-                        self._dict_to_xml(child, item)
-                        parent.append(child)
-                    else:
-                        child = self._create_element_with_ns(key, str(item))
-                        parent.append(child)
+                # Lists - multiple elements with the same tag
+                children.extend((key, item) for item in value)
             else:
-                # Simple element with text content
-                child = self._create_element_with_ns(key, str(value))
-                parent.append(child)
-
-    def json_to_xml(self, json_data: dict[str, Any],
-                         root_tag: str = "ElkOrderRequest") -> str:
-        try:
-            # Create root element
-            root = self._create_element_with_ns(root_tag)
-
-            # Convert dictionary to XML
-            self._dict_to_xml(root, json_data, is_root=True)
-
-            # Create XML tree
-            tree = ET.ElementTree(root)
-
-            # Format XML for better readability
-            xml_str = ET.tostring(root, encoding='unicode')
-            xml_pretty = self._prettify_xml(xml_str)
-
-            return xml_pretty
-
-        except Exception as e:
-            raise Exception(f"Error creating XML file")
+                children.append((key, value))
 
-    def _prettify_xml(self, xml_string: str) -> str:
-        try:
-            parsed = minidom.parseString(xml_string)
-            return parsed.toprettyxml(indent="  ", encoding='utf-8').decode('utf-8')
-        except:
-            # Fallback to simple formatting if minidom fails
-            return xml_string
+        if builder is not None:
+            builder.start(f"{{{NAMESPACE}}}{tag}",
+                          {name: _parsed_attribute(value) for name, value in attributes.items()})
+            if text:
+                builder.data(_parsed_text(text))
+        write(f"{indent}<{qname}{namespace_declaration}")
+        for name, value in attributes.items():
+            write(f' {name}="{_escape(value)}"')
+        if not text and not children:
+            write(f"/>{newl}")
+        elif not children:
+            write(f">{_escape(text)}</{qname}>{newl}")
+        else:
+            write(f">{newl}")
+            child_indent = indent + addindent
+            if text:
+                write(f"{child_indent}{_escape(text)}{newl}")
+            for key, value in children:
+                self._write_element(write, builder, key, value, child_indent, addindent, newl)
+            write(f"{indent}</{qname}>{newl}")
+        if builder is not None:
+            builder.end(f"{{{NAMESPACE}}}{tag}")
 
-    def validate_xml(self, xml_str: str) -> dict[str, Any]:
+    def validate(self, xml: str | bytes | ET.Element | ET.ElementTree) -> dict[str, Any]:
+        """
+        Validate against the XSD in a single pass: XML text is parsed once, an element or tree
+        (e.g. from json_to_xml_tree) is used as is, and all errors are collected by one iter_errors run.
+        """
         result = {
             'valid': False,
             'errors': [],
@@ -102,65 +221,114 @@ class XMLGenerator:
         if not self.schema:
             result['errors'].append("XSD schema not loaded")
             return result
-        try:
-            # Validate against schema
-            validation_result = self.schema.validate(xml_str)
-
-            if validation_result is None:
-                result['valid'] = True
-                result['message'] = "XML is valid according to XSD schema"
-            else:
-                result['valid'] = False
-                # Try to get more detailed error information
-                try:
-                    errors = list(self.schema.iter_errors(xml_str))
-                    for error in errors:
-                        result['errors'].append(str(error))
-                except:
-                    result['errors'].append("XML validation failed")
 
+        try:
+            source = ET.fromstring(xml) if isinstance(xml, (str, bytes)) else xml
+            result['errors'] = [str(error) for error in self.schema.iter_errors(source)]
+        except ET.ParseError as e:
+            result['errors'].append(f"XML parsing error: {e}")
+            return result
         except Exception as e:
             result['errors'].append(f"Validation error: {e}")
+            return result
 
+        if not result['errors']:
+            result['valid'] = True
+            result['message'] = "XML is valid according to XSD schema"
         return result
 
+    def validate_xml(self, xml_str: str) -> dict[str, Any]:
+        return self.validate(xml_str)
+
     def validate_xml_string(self, xml_string: str) -> dict[str, Any]:
-        result = {
-            'valid': False,
-            'errors': [],
-            'warnings': []
-        }
+        return self.validate(xml_string)
 
-        if not self.schema:
-            result['errors'].append("XSD schema not loaded")
-            return result
 
-        try:
-            # Parse XML string
-            root = ET.fromstring(xml_string)
+# XMLGenerator of a validation worker process, loaded once by _init_validation_worker
+_worker_generator: XMLGenerator = None
 
-            # Convert back to string for validation
-            xml_bytes = ET.tostring(root, encoding='utf-8')
+def _init_validation_worker(xsd_path: str, cache_path: str):
+    global _worker_generator
+    _worker_generator = XMLGenerator(xsd_path, cache_path)
 
-            # Validate
-            validation_result = self.schema.validate(xml_bytes)
+def _validate_in_worker(xml: str) -> dict[str, Any]:
+    return _worker_generator.validate(xml)
 
-            if validation_result is True:
-                result['valid'] = True
-                result['message'] = "XML is valid according to XSD schema"
-            else:
-                result['valid'] = False
-                # Try to get more detailed error information
-                try:
-                    errors = list(self.schema.iter_errors(xml_bytes))
-                    for error in errors:
-                        result['errors'].append(str(error))
-                except:
-                    result['errors'].append("XML validation failed")
 
-        except ET.ParseError as e:
-            result['errors'].append(f"XML parsing error: {e}")
+class ValidationPool:
+    """
+    XSD validation in worker processes, each loading the schema once (from the schema cache if given).
+    submit(xml, callback, *args) queues a document; callback(*args, validation_result) is called in
+    the calling process in submission order, from poll()/submit() once the result is ready or from
+    drain(). At most max_pending documents are in flight, so filling and XML generation of the next
+    records overlap with validation of the previous ones.
+    With workers=0 documents are validated inline by the generator and the callback is called at once;
+    element (the tree of xml from json_to_xml_tree) is then validated instead, so xml is not parsed at all.
+    Workers always get the text: pickling the tree to them costs about as much as parsing it there.
+    """
+    def __init__(self, generator: XMLGenerator, workers: int = 0, max_pending: int = None):
+        self.generator = generator
+        self.executor = None
+        if workers > 0 and generator.schema is not None:
+            # spawn: the main process holds SSH tunnels and DB connections, they must not be forked
+            self.executor = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_validation_worker,
+                initargs=(str(generator.xsd_path), None if generator.cache_path is None else str(generator.cache_path)),
+            )
+        self.max_pending = max_pending or 4 * max(workers, 1)
+        self.pending = deque()
+
+    def submit(self, xml: str, callback: Callable, *args, element: ET.Element = None):
+        if self.executor is None:
+            callback(*args, self.generator.validate(xml if element is None else element))
+            return
+        try:
+            future = self.executor.submit(_validate_in_worker, xml)
+        except BrokenProcessPool:
+            # A worker died: validate the rest in the main process
+            self.drain()
+            self.executor = None
+            callback(*args, self.generator.validate(xml if element is None else element))
+            return
+        self.pending.append((future, callback, args))
+        self.poll()
+        while len(self.pending) > self.max_pending:
+            self._finish_oldest()
+
+    def poll(self):
+        """Hand over the results that are ready (without waiting)."""
+        while self.pending and self.pending[0][0].done():
+            self._finish_oldest()
+
+    def drain(self):
+        """Wait for all submitted documents and hand over their results."""
+        while self.pending:
+            self._finish_oldest()
+
+    def _finish_oldest(self):
+        future, callback, args = self.pending.popleft()
+        try:
+            validation_result = future.result()
         except Exception as e:
-            result['errors'].append(f"Validation error: {e}")
+            validation_result = {'valid': False, 'errors': [f"Validation error: {e}"], 'warnings': []}
+        callback(*args, validation_result)
 
-        return result
+    def close(self, discard_pending: bool = False):
+        """Stop the workers. Pending results are handed over first, unless discard_pending
+        (their records keep the status they had before and are validated again in the next cycle)."""
+        if discard_pending:
+            self.pending.clear()
+        else:
+            self.drain()
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=discard_pending)
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # After an error (or Ctrl+C, which also stops the workers) the pending results are not trusted
+        self.close(discard_pending=exc_type is not None)
@@ -0,0 +1,194 @@
+from decimal import Decimal, InvalidOperation
+import re
+from typing import Any
+
+import xmlschema
+
+
+XSD_NAMESPACE = "http://www.w3.org/2001/XMLSchema"
+
+# Lexical forms of the primitive types used by the schema, other primitives are left to the full validation
+_LEXICAL = {
+    "decimal": re.compile(r"[+-]?(\d+(\.\d*)?|\.\d+)"),
+    "integer": re.compile(r"[+-]?\d+"),
+    "boolean": re.compile(r"true|false|1|0"),
+    "date": re.compile(r"-?\d{4,}-(0[1-9]|1[0-2])-(0[1-9]|[12]\d|3[01])(Z|[+-]\d{2}:\d{2})?"),
+    "dateTime": re.compile(r"-?\d{4,}-(0[1-9]|1[0-2])-(0[1-9]|[12]\d|3[01])"
+                           r"T(([01]\d|2[0-3]):[0-5]\d:[0-5]\d(\.\d+)?|24:00:00(\.0+)?)(Z|[+-]\d{2}:\d{2})?"),
+}
+
+
+class SimpleTypeFacets:
+    """
+    Facets of one XSD simple type (own and inherited), extracted once from the compiled schema:
+    whiteSpace, length/minLength/maxLength, pattern, enumeration, min/max inclusive/exclusive
+    and the lexical form of the primitive type (decimal, integer, boolean, date, dateTime).
+    """
+    __slots__ = ("name", "lexical", "white_space", "length", "min_length", "max_length",
+                 "patterns", "enumeration", "enumeration_type",
+                 "min_inclusive", "max_inclusive", "min_exclusive", "max_exclusive")
+
+    def __init__(self, xsd_type):
+        self.name = xsd_type.local_name or xsd_type.primitive_type.local_name
+        self.white_space = xsd_type.white_space or "preserve"
+        self.length = self.min_length = self.max_length = None
+        self.patterns = []  # (source regexps, compiled regexes) per pattern facet: one of a facet's regexps
+        # must match (they are alternatives), every facet on the derivation chain must be satisfied
+        self.enumeration = None
+        self.enumeration_type = None  # base type decoding the values of a non-string enumeration
+        self.min_inclusive = self.max_inclusive = self.min_exclusive = self.max_exclusive = None
+
+        primitive = xsd_type.primitive_type.local_name
+        self.lexical = _LEXICAL.get(primitive)
+        # The facets of the most derived type win, so walk up from xsd_type and keep the first seen
+        t = xsd_type
+        while t is not None and getattr(t, "facets", None) is not None:
+            if t.local_name == "integer" and t.target_namespace == XSD_NAMESPACE:
+                self.lexical = _LEXICAL["integer"]
+            for key, facet in t.facets.items():
+                name = str(key).rsplit("}", 1)[-1]
+                if name == "pattern":
+                    self.patterns.append((facet.regexps, facet.patterns))
+                elif name == "enumeration" and self.enumeration is None:
+                    if primitive == "string":
+                        self.enumeration = {str(value) for value in facet.enumeration}
+                    else:
+                        # Compared by value: "1.0" and "01" match an enumerated decimal 1, "1" as text does not
+                        self.enumeration = list(facet.enumeration)
+                        self.enumeration_type = facet.base_type
+                elif name in ("length", "minLength", "maxLength"):
+                    attr = {"length": "length", "minLength": "min_length", "maxLength": "max_length"}[name]
+                    if getattr(self, attr) is None:
+                        setattr(self, attr, facet.value)
+                elif name in ("minInclusive", "maxInclusive", "minExclusive", "maxExclusive"):
+                    attr = re.sub(r"([A-Z])", r"_\1", name).lower()
+                    if getattr(self, attr) is None:
+                        setattr(self, attr, Decimal(str(facet.value)))
+            t = t.base_type
+
+    def check(self, value: Any) -> str | None:
+        """The first violated facet of str(value) (as it would be serialized), or None."""
+        text = str(value)
+        if self.white_space != "preserve":
+            text = re.sub(r"[\t\n\r]", " ", text)
+            if self.white_space == "collapse":
+                text = " ".join(text.split())
+        if self.lexical is not None and not self.lexical.fullmatch(text):
+            return f"{text!r} is not a valid {self.name}"
+        if self.length is not None and len(text) != self.length:
+            return f"{text!r} has length {len(text)}, expected {self.length}"
+        if self.min_length is not None and len(text) < self.min_length:
+            return f"{text!r} is shorter than minLength {self.min_length}"
+        if self.max_length is not None and len(text) > self.max_length:
+            return f"{text!r} ({len(text)} chars) is longer than maxLength {self.max_length}"
+        for sources, patterns in self.patterns:
+            if not any(pattern.match(text) for pattern in patterns):
+                return f"{text!r} does not match pattern {' | '.join(sources)!r}"
+        if self.enumeration is not None and not self._in_enumeration(text):
+            return f"{text!r} is not one of {sorted(str(value) for value in self.enumeration)}"
+        if self.min_inclusive is not None or self.max_inclusive is not None or \
+           self.min_exclusive is not None or self.max_exclusive is not None:
+            try:
+                number = Decimal(text)
+            except InvalidOperation:
+                return f"{text!r} is not a number"
+            if self.min_inclusive is not None and number < self.min_inclusive:
+                return f"{text} is less than minInclusive {self.min_inclusive}"
+            if self.max_inclusive is not None and number > self.max_inclusive:
+                return f"{text} is greater than maxInclusive {self.max_inclusive}"
+            if self.min_exclusive is not None and number <= self.min_exclusive:
+                return f"{text} is not greater than minExclusive {self.min_exclusive}"
+            if self.max_exclusive is not None and number >= self.max_exclusive:
+                return f"{text} is not less than maxExclusive {self.max_exclusive}"
+        return None
+
+    def _in_enumeration(self, text: str) -> bool:
+        if self.enumeration_type is None:
+            return text in self.enumeration
+        try:
+            return self.enumeration_type.decode(text) in self.enumeration
+        except Exception:
+            return False
+
+
+class FacetNode:
+    """Facets of one element type: its simple content, its attributes and its child elements by tag."""
+    __slots__ = ("content", "attributes", "children")
+
+    def __init__(self):
+        self.content: SimpleTypeFacets | None = None
+        self.attributes: dict[str, SimpleTypeFacets] = {}
+        self.children: dict[str, "FacetNode"] = {}
+
+
+class FacetChecker:
+    """
+    Checks the simple-type facets of a filled template (the dict passed to XMLGenerator.json_to_xml)
+    without building any XML. The schema is compiled once into a tree of FacetNode by element tag,
+    the filled dict is walked with the same mapping as write_xml (`_` keys skipped, `@` keys are attributes,
+    `#text` is the text, lists repeat the tag).
+    Only facets are checked: structure (order, occurrence, unknown elements) is left to the full XSD validation.
+    """
+    def __init__(self, schema: xmlschema.XMLSchema):
+        self.roots: dict[str, FacetNode] = {}
+        nodes: dict[int, FacetNode] = {}  # by id of the XSD type, shared and recursive types are compiled once
+        for name, element in schema.elements.items():
+            self.roots[name] = self._compile(element.type, nodes)
+
+    def _compile(self, xsd_type, nodes: dict[int, FacetNode]) -> FacetNode:
+        node = nodes.get(id(xsd_type))
+        if node is not None:
+            return node
+        node = nodes[id(xsd_type)] = FacetNode()
+        if xsd_type.is_simple():
+            node.content = SimpleTypeFacets(xsd_type)
+            return node
+        if xsd_type.has_simple_content():
+            node.content = SimpleTypeFacets(xsd_type.content)
+        for name, attribute in xsd_type.attributes.items():
+            if name is not None and attribute.type is not None and attribute.type.is_simple():
+                node.attributes[attribute.local_name] = SimpleTypeFacets(attribute.type)
+        if not xsd_type.has_simple_content() and xsd_type.content is not None:
+            for child in xsd_type.content.iter_elements():
+                if child.local_name is not None and child.local_name not in node.children:
+                    node.children[child.local_name] = self._compile(child.type, nodes)
+        return node
+
+    def check(self, json_data: dict[str, Any], root_tag: str = "ElkOrderRequest") -> list[str]:
+        """All facet violations as "path: message", path like CreateOrdersRequest/orders/order[0]/senderInn."""
+        errors = []
+        root = self.roots.get(root_tag)
+        if root is not None:
+            self._check_dict(root, json_data, root_tag, errors)
+        return errors
+
+    def _check_dict(self, node: FacetNode, data: dict[str, Any], path: str, errors: list[str]):
+        for key, value in data.items():
+            if key.startswith('_'):
+                continue
+            if key.startswith('@'):
+                facets = node.attributes.get(key[1:])
+                error = facets.check(value) if facets is not None else None
+                if error is not None:
+                    errors.append(f"{path}/{key}: {error}")
+            elif key == '#text':
+                error = node.content.check(value) if node.content is not None else None
+                if error is not None:
+                    errors.append(f"{path}: {error}")
+            else:
+                child = node.children.get(key)
+                if child is None:
+                    continue
+                if isinstance(value, list):
+                    for i, item in enumerate(value):
+                        self._check_value(child, item, f"{path}/{key}[{i}]", errors)
+                else:
+                    self._check_value(child, value, f"{path}/{key}", errors)
+
+    def _check_value(self, node: FacetNode, value: Any, path: str, errors: list[str]):
+        if isinstance(value, dict):
+            self._check_dict(node, value, path, errors)
+        elif node.content is not None:
+            error = node.content.check(value)
+            if error is not None:
+                errors.append(f"{path}: {error}")